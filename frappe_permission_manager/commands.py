@@ -0,0 +1,32 @@
+# Copyright (c) 2025, Dhwani RIS and contributors
+# License: MIT
+
+import click
+from frappe.commands import get_site, pass_context
+
+
+@click.command("benchmark-user-permissions")
+@click.option("--users", default=1000, type=int, help="Number of users holding the benchmark role")
+@click.option("--rows", default=20, type=int, help="Number of mapper rows in the benchmark manager")
+@click.option("--output", help="Path of the JSON results file")
+@pass_context
+def benchmark_user_permissions(context, users, rows, output=None):
+    "Benchmark User Permissions Manager insert, incremental edit, role change and trash"
+    import frappe
+
+    from frappe_permission_manager.frappe_permission_manager.benchmark import run_benchmark
+
+    site = get_site(context)
+    frappe.init(site=site)
+    frappe.connect()
+    try:
+        results = run_benchmark(users=users, rows=rows, output=output)
+        for stage, stats in results["stages"].items():
+            click.echo(
+                f"{stage}: {stats['seconds']}s, {stats['queries']} queries, {stats['rows_written']} rows written"
+            )
+    finally:
+        frappe.destroy()
+
+
+commands = [benchmark_user_permissions]
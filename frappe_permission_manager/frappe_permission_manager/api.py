@@ -1,8 +1,26 @@
-import frappe
 import json
 
+import frappe
+from frappe.desk.form.linked_with import get_linked_doctypes
+from frappe.utils import cint
+
+# Role member lists are cached briefly so that each keystroke in the Users
+# multiselect does not rescan `tabHas Role`
+ROLE_MEMBERS_CACHE_TTL = 60
+# Up to this many role members are matched with `IN (...)`; larger sets are
+# joined against `tabHas Role` instead
+ROLE_MEMBERS_INLINE_LIMIT = 1000
+# Applicable-for doctypes per allow doctype, dropped whenever doctype metadata changes
+APPLICABLE_FOR_CACHE_KEY = "user_permissions_manager_applicable_for"
+
+
 @frappe.whitelist()
 def user_multiselect_query(doctype, txt, searchfield, start, page_len, filters):
+    """Search enabled users by name or full name prefix, optionally limited to role members.
+
+    Results are ordered by user name and paged by `start`, as the link widget
+    requests them.
+    """
     roles = filters.get("roles", [])
     if isinstance(roles, str):
         roles = json.loads(roles)
@@ -10,31 +28,77 @@ def user_multiselect_query(doctype, txt, searchfield, start, page_len, filters):
     if not roles:
         roles = []
 
+    User = frappe.qb.DocType("User")
+    query = (
+        frappe.qb.from_(User)
+        .select(User.name, User.full_name)
+        .distinct()
+        .where(User.enabled == 1)
+        .orderby(User.name)
+        .limit(cint(page_len))
+        .offset(cint(start))
+    )
+
+    if txt:
+        query = query.where(User.name.like(f"{txt}%") | User.full_name.like(f"{txt}%"))
+
     if roles:
-        return frappe.db.sql("""
-            SELECT u.name, u.full_name
-            FROM `tabUser` u
-            WHERE u.name IN (
-                SELECT DISTINCT parent
-                FROM `tabHas Role`
-                WHERE role IN %(roles)s
+        members = get_role_members(roles)
+        if not members:
+            return []
+
+        if len(members) <= ROLE_MEMBERS_INLINE_LIMIT:
+            query = query.where(User.name.isin(members))
+        else:
+            HasRole = frappe.qb.DocType("Has Role")
+            query = query.join(HasRole).on(
+                (HasRole.parent == User.name) & (HasRole.parenttype == "User") & HasRole.role.isin(roles)
             )
-            AND u.name LIKE %(txt)s
-            LIMIT %(start)s, %(page_len)s
-        """, {
-            "roles": roles,
-            "txt": f"%{txt}%",
-            "start": start,
-            "page_len": page_len
-        })
-    else:
-        return frappe.db.sql("""
-            SELECT u.name, u.full_name
-            FROM `tabUser` u
-            WHERE u.name LIKE %(txt)s
-            LIMIT %(start)s, %(page_len)s
-        """, {
-            "txt": f"%{txt}%",
-            "start": start,
-            "page_len": page_len
-        })
+
+    return query.run()
+
+
+def get_role_members(roles):
+    """Return the sorted users holding any of `roles`, cached for `ROLE_MEMBERS_CACHE_TTL` seconds."""
+    key = "user_permissions_manager_role_members::" + "|".join(sorted(roles))
+    members = frappe.cache.get_value(key)
+    if members is None:
+        members = sorted(set(frappe.get_all(
+            "Has Role",
+            filters={"role": ["in", roles], "parenttype": "User"},
+            pluck="parent",
+        )))
+        frappe.cache.set_value(key, members, expires_in_sec=ROLE_MEMBERS_CACHE_TTL)
+    return members
+
+
+@frappe.whitelist()
+def get_applicable_for_doctypes(doctypes):
+    """Return {allow: [doctypes]} with the applicable-for choices of each of `doctypes` in one call."""
+    frappe.has_permission("User Permissions Manager", "read", throw=True)
+    if isinstance(doctypes, str):
+        doctypes = json.loads(doctypes)
+    return {doctype: get_applicable_for(doctype) for doctype in dict.fromkeys(doctypes or []) if doctype}
+
+
+def get_applicable_for(doctype):
+    """Return the sorted doctypes a User Permission on `doctype` can apply to, cached per doctype.
+
+    Follows `frappe.core.doctype.user_permission.user_permission.get_applicable_for_doctype_list`:
+    the doctype itself, the doctypes linking to it and their parents.
+    """
+    doctypes = frappe.cache.hget(APPLICABLE_FOR_CACHE_KEY, doctype)
+    if doctypes is None:
+        doctypes = {doctype}
+        for linked_doctype, values in get_linked_doctypes(doctype, True).items():
+            doctypes.add(linked_doctype)
+            if values.get("child_doctype"):
+                doctypes.add(values["child_doctype"])
+        doctypes = sorted(doctypes)
+        frappe.cache.hset(APPLICABLE_FOR_CACHE_KEY, doctype, doctypes)
+    return doctypes
+
+
+def invalidate_applicable_for(doc, method=None):
+    """DocType, Custom Field and Property Setter hook: links to any doctype may have changed."""
+    frappe.cache.delete_value(APPLICABLE_FOR_CACHE_KEY)
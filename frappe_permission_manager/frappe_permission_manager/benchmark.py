@@ -0,0 +1,133 @@
+# Copyright (c) 2025, Dhwani RIS and contributors
+# License: MIT
+
+"""Synthetic-scale benchmark for the User Permissions Manager apply, update and delete paths.
+
+Run it on a staging site, either as a bench command::
+
+    bench --site staging.local benchmark-user-permissions --users 2000 --rows 30
+
+or through `bench execute`::
+
+    bench --site staging.local execute \\
+        frappe_permission_manager.frappe_permission_manager.benchmark.run_benchmark \\
+        --kwargs "{'users': 2000, 'rows': 30}"
+
+All generated data is created inside one transaction that is rolled back at
+the end, so the site is left as it was.
+"""
+
+import json
+import time
+from contextlib import contextmanager
+
+import frappe
+from frappe.utils import now
+
+import frappe_permission_manager
+from frappe_permission_manager.frappe_permission_manager.instrumentation import count_queries
+
+BENCHMARK_ROLE = "User Permissions Manager Benchmark"
+BENCHMARK_PREFIX = "upm-benchmark"
+
+
+def run_benchmark(users=1000, rows=20, output=None):
+    """Time insert, incremental edit, role change and trash of a role-based manager.
+
+    Records wall time, SQL query count and rows written per stage, writes the
+    results as JSON to `output` (default: `user_permissions_benchmark.json` in
+    the site directory) and returns them.
+    """
+    users = int(users)
+    rows = int(rows)
+    output = output or frappe.get_site_path("user_permissions_benchmark.json")
+
+    threshold = frappe.conf.get("user_permissions_manager_background_threshold")
+    # Measure the synchronous path regardless of the site's threshold
+    frappe.conf.user_permissions_manager_background_threshold = (users + 1) * (rows + 1)
+
+    results = {
+        "version": frappe_permission_manager.__version__,
+        "timestamp": now(),
+        "users": users,
+        "rows": rows,
+        "stages": {},
+    }
+
+    try:
+        frappe.db.set_single_value("System Settings", "apply_strict_user_permissions", 1)
+        _, extra_user, values = _generate_data(users, rows)
+
+        with _measure(results, "insert"):
+            doc = frappe.get_doc({
+                "doctype": "User Permissions Manager",
+                "name": f"{BENCHMARK_PREFIX}-manager",
+                "roles": [{"role": BENCHMARK_ROLE}],
+                "apply_to_role": 1,
+                "user_permission_manager_mapper": [
+                    {"allow": "ToDo", "for_value": value, "apply_to_all_doctypes": 1} for value in values[:rows]
+                ],
+            }).insert(set_name=f"{BENCHMARK_PREFIX}-manager")
+
+        with _measure(results, "incremental_edit"):
+            doc.user_permission_manager_mapper[0].for_value = values[rows]
+            doc.save()
+
+        with _measure(results, "role_change"):
+            frappe.get_doc("User", extra_user).add_roles(BENCHMARK_ROLE)
+
+        with _measure(results, "trash"):
+            frappe.delete_doc("User Permissions Manager", doc.name)
+    finally:
+        frappe.db.rollback()
+        frappe.clear_document_cache("System Settings", "System Settings")
+        frappe.conf.user_permissions_manager_background_threshold = threshold
+
+    with open(output, "w") as f:
+        json.dump(results, f, indent=1)
+
+    return results
+
+
+@contextmanager
+def _measure(results, stage):
+    with count_queries() as stats:
+        start = time.perf_counter()
+        yield
+        stats["seconds"] = round(time.perf_counter() - start, 4)
+    results["stages"][stage] = stats
+
+
+def _generate_data(users, rows):
+    """Bulk insert the benchmark role, users with that role, one extra user without it and rows + 1 ToDos."""
+    timestamp = now()
+    owner = frappe.session.user
+
+    if not frappe.db.exists("Role", BENCHMARK_ROLE):
+        frappe.get_doc({"doctype": "Role", "role_name": BENCHMARK_ROLE, "desk_access": 1}).insert()
+
+    user_names = [f"{BENCHMARK_PREFIX}-{i}@example.com" for i in range(users + 1)]
+    frappe.db.bulk_insert(
+        "User",
+        fields=["name", "email", "first_name", "full_name", "enabled", "user_type", "creation", "modified", "owner", "modified_by"],
+        values=[
+            (name, name, name, name, 1, "System User", timestamp, timestamp, owner, owner) for name in user_names
+        ],
+    )
+    frappe.db.bulk_insert(
+        "Has Role",
+        fields=["name", "parent", "parenttype", "parentfield", "role", "idx", "creation", "modified", "owner", "modified_by"],
+        values=[
+            (frappe.generate_hash(length=10), name, "User", "roles", BENCHMARK_ROLE, 1, timestamp, timestamp, owner, owner)
+            for name in user_names[:users]
+        ],
+    )
+
+    values = [f"{BENCHMARK_PREFIX}-{i}" for i in range(rows + 1)]
+    frappe.db.bulk_insert(
+        "ToDo",
+        fields=["name", "description", "status", "priority", "creation", "modified", "owner", "modified_by"],
+        values=[(name, name, "Open", "Medium", timestamp, timestamp, owner, owner) for name in values],
+    )
+
+    return user_names[:users], user_names[users], values
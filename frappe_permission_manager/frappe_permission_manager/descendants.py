@@ -0,0 +1,118 @@
+# Copyright (c) 2025, Dhwani RIS and contributors
+# License: MIT
+
+"""Effective access of User Permissions on tree doctypes.
+
+A User Permission on a nested set value also grants its descendants unless
+`hide_descendants` is set. Subtrees are resolved with one lft/rgt range
+query per value and cached in one Redis hash per doctype, which is dropped
+whenever a record of that doctype is inserted, moved, renamed or deleted.
+"""
+
+from collections import defaultdict
+
+import frappe
+from frappe.utils import scrub
+
+from frappe_permission_manager.frappe_permission_manager.doctype.user_permissions_manager.user_permissions_manager import (
+    USER_PARENTFIELDS,
+    _chunk,
+    get_manager_rows,
+)
+
+DESCENDANTS_CACHE_KEY = "user_permissions_manager_descendants"
+
+
+def get_descendants(doctype, value):
+    """Return `value` and every record below it in the `doctype` tree."""
+    key = f"{DESCENDANTS_CACHE_KEY}::{doctype}"
+    descendants = frappe.cache.hget(key, value)
+    if descendants is None:
+        bounds = frappe.db.get_value(doctype, value, ["lft", "rgt"])
+        if not bounds:
+            return [value]
+        descendants = frappe.get_all(
+            doctype,
+            filters={"lft": [">=", bounds[0]], "rgt": ["<=", bounds[1]]},
+            pluck="name",
+            order_by="lft",
+        )
+        frappe.cache.hset(key, value, descendants)
+    return descendants
+
+
+def get_effective_values(doctype, value, hide_descendants):
+    if hide_descendants or not frappe.get_meta(doctype).is_nested_set():
+        return [value]
+    return get_descendants(doctype, value)
+
+
+def invalidate_descendants(doc, method=None, *args):
+    """Document hook: drop the cached subtrees of a tree doctype whose shape may have changed.
+
+    Other doctypes return on the document's already loaded meta, without a query.
+    """
+    if not doc.meta.is_nested_set():
+        return
+
+    if method == "on_update" and not doc.flags.in_insert:
+        parent_field = getattr(doc, "nsm_parent_field", None) or "parent_" + scrub(doc.doctype)
+        if not doc.has_value_changed(parent_field):
+            return
+
+    frappe.cache.delete_value(f"{DESCENDANTS_CACHE_KEY}::{doc.doctype}")
+
+
+@frappe.whitelist()
+def get_effective_value_counts(docname):
+    """Return the number of records each mapper row grants, and each user's effective count per doctype.
+
+    The per-user counts cover all of the user's User Permissions on the
+    manager's doctypes, not only the ones this manager gives.
+    """
+    frappe.has_permission("User Permissions Manager", "read", docname, throw=True)
+    rows = get_manager_rows(docname)
+    users = frappe.get_all(
+        "User Permissions Manager Child User",
+        filters={
+            "parent": docname,
+            "parenttype": "User Permissions Manager",
+            "parentfield": ["in", USER_PARENTFIELDS],
+        },
+        pluck="user",
+    )
+    doctypes = list({row.allow for row in rows})
+
+    granted = defaultdict(set)
+    for chunk in _chunk(users):
+        for perm in frappe.get_all(
+            "User Permission",
+            filters={"user": ["in", chunk], "allow": ["in", doctypes]},
+            fields=["user", "allow", "for_value", "hide_descendants"],
+        ):
+            granted[(perm.user, perm.allow)].add((perm.for_value, perm.hide_descendants))
+
+    # Users holding the same values share one expansion
+    counts = {}
+    per_user = defaultdict(dict)
+    for (user, allow), values in granted.items():
+        signature = (allow, frozenset(values))
+        if signature not in counts:
+            counts[signature] = len({
+                name
+                for value, hide_descendants in values
+                for name in get_effective_values(allow, value, hide_descendants)
+            })
+        per_user[user][allow] = counts[signature]
+
+    return {
+        "rows": [
+            {
+                "allow": row.allow,
+                "for_value": row.for_value,
+                "count": len(get_effective_values(row.allow, row.for_value, row.hide_descendants)),
+            }
+            for row in rows
+        ],
+        "users": per_user,
+    }
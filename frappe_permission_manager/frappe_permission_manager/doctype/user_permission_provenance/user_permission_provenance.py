@@ -0,0 +1,18 @@
+# Copyright (c) 2026, Dhwani RIS and contributors
+# For license information, please see license.txt
+
+import frappe
+from frappe.model.document import Document
+
+
+class UserPermissionProvenance(Document):
+	pass
+
+
+def on_doctype_update():
+	frappe.db.add_index("User Permission Provenance", ["manager", "permission_key"])
+
+
+def on_user_permission_trash(doc, method=None):
+	"""Forget ledger entries of a User Permission deleted outside the managers."""
+	frappe.db.delete("User Permission Provenance", {"user_permission": doc.name})
@@ -1,8 +1,25 @@
+import os
+from unittest.mock import patch
+
 import frappe
 from frappe.tests.utils import FrappeTestCase
-from user_permissions_manager.user_permissions_manager.doctype.user_permissions_manager.user_permissions_manager import (
-    apply_bulk_user_permissions, delete_user_permissions
+from frappe_permission_manager.frappe_permission_manager.api import (
+    APPLICABLE_FOR_CACHE_KEY, get_applicable_for_doctypes, invalidate_applicable_for
+)
+from frappe_permission_manager.frappe_permission_manager.descendants import get_effective_value_counts
+from frappe_permission_manager.frappe_permission_manager.importer import import_lines, read_lines
+from frappe_permission_manager.frappe_permission_manager.paged_rows import (
+    add_paged_users, delete_paged_rows, get_paged_rows, upsert_paged_rows
 )
+from frappe_permission_manager.frappe_permission_manager.reconcile import reconcile_user_permissions
+from frappe_permission_manager.frappe_permission_manager.doctype.user_permissions_manager.user_permissions_manager import (
+    apply_bulk_user_permissions, apply_bulk_user_permissions_batch, apply_permission_delta,
+    delete_user_permissions, enqueue_permission_jobs, get_managed_doctypes, get_manager_rows, permission_locks,
+    plan_user_permissions, preview_user_permissions, run_permission_cleanup, run_permission_partition,
+    run_permission_sync, write_user_permissions
+)
+
+MODULE = "frappe_permission_manager.frappe_permission_manager.doctype.user_permissions_manager.user_permissions_manager"
 
 class TestUserPermissionsManager(FrappeTestCase):
     def setUp(self):
@@ -29,9 +46,15 @@ class TestUserPermissionsManager(FrappeTestCase):
         self.note = frappe.get_doc("Note", {"title": self.note_title})
 
     def tearDown(self):
+        # Raw deletes skip child tables; leftovers would leak into site-wide scans such as reconcile
+        for child in ("User Permissions Manager Child", "User Permissions Manager Child User", "User Permissions Manager Child Role"):
+            frappe.db.delete(child, {"parenttype": "User Permissions Manager"})
         frappe.db.delete("User Permissions Manager")
+        frappe.db.delete("User Permission Provenance")
+        frappe.db.delete("User Permissions Manager Log")
         frappe.db.delete("User Permission", {"user": ["in", [self.test_user, self.second_user]]})
         frappe.db.delete("Note", {"title": ["in", ["Test Note", "Another Note", "Note A", "Note B", "Updated Note"]]})
+        frappe.db.delete("Has Role", {"parent": ["in", [self.test_user, self.second_user]], "parenttype": "User"})
         frappe.db.delete("User", {"email": ["in", [self.test_user, self.second_user]]})
         frappe.db.commit()
 
@@ -430,3 +453,774 @@ class TestUserPermissionsManager(FrappeTestCase):
         }))
 
     
+
+    def test_plan_splits_inserts_and_skips(self):
+        another_note = frappe.get_doc({
+            "doctype": "Note",
+            "title": "Another Note",
+            "content": "Note 2"
+        }).insert()
+        doc = frappe.get_doc({
+            "doctype": "User Permissions Manager",
+            "users": [{"user": self.test_user}, {"user": self.second_user}],
+            "user_permission_manager_mapper": [{
+                "allow": "Note",
+                "for_value": self.note.name,
+                "apply_to_all_doctypes": 1
+            }]
+        }).insert()
+
+        doc.append("user_permission_manager_mapper", {
+            "allow": "Note",
+            "for_value": another_note.name,
+            "apply_to_all_doctypes": 0,
+            "applicable_for": "ToDo"
+        })
+        plan = plan_user_permissions(doc.user_permission_manager_mapper, doc.get_user_list())
+
+        self.assertEqual(len(plan["skip"]), 2)
+        self.assertEqual(len(plan["insert"]), 2)
+        self.assertEqual({d["docname"] for d in plan["insert"]}, {another_note.name})
+
+    def test_bulk_insert_reports_existing_default_conflict(self):
+        another_note = frappe.get_doc({
+            "doctype": "Note",
+            "title": "Another Note",
+            "content": "Note 2"
+        }).insert()
+        # A default set by hand, outside any manager, is only found when writing
+        frappe.get_doc({
+            "doctype": "User Permission",
+            "user": self.test_user,
+            "allow": "Note",
+            "for_value": self.note.name,
+            "is_default": 1,
+            "apply_to_all_doctypes": 1
+        }).insert()
+
+        doc = frappe.get_doc({
+            "doctype": "User Permissions Manager",
+            "users": [{"user": self.test_user}, {"user": self.second_user}],
+            "user_permission_manager_mapper": [{
+                "allow": "Note",
+                "for_value": another_note.name,
+                "is_default": 1,
+                "apply_to_all_doctypes": 1
+            }]
+        })
+        doc.flags.ignore_after_insert = True
+        doc.insert()
+        result = apply_bulk_user_permissions(doc.name, batch_size=1)
+
+        self.assertEqual(len(result["errors"]), 1)
+        self.assertTrue(frappe.db.exists("User Permission", {
+            "user": self.second_user,
+            "for_value": another_note.name,
+            "is_default": 1
+        }))
+
+    def test_delete_reports_removed_rows(self):
+        doc = frappe.get_doc({
+            "doctype": "User Permissions Manager",
+            "users": [{"user": self.test_user}, {"user": self.second_user}],
+            "user_permission_manager_mapper": [
+                {
+                    "allow": "Note",
+                    "for_value": self.note.name,
+                    "apply_to_all_doctypes": 0,
+                    "applicable_for": "ToDo"
+                },
+                {
+                    "allow": "Note",
+                    "for_value": self.note.name,
+                    "apply_to_all_doctypes": 0,
+                    "applicable_for": "Event"
+                }
+            ]
+        }).insert()
+
+        self.assertEqual(delete_user_permissions(doc.name), 4)
+        self.assertFalse(frappe.db.exists("User Permission", {
+            "user": ["in", [self.test_user, self.second_user]],
+            "for_value": self.note.name
+        }))
+
+    def test_user_list_resolved_once_until_invalidated(self):
+        doc = frappe.get_doc({
+            "doctype": "User Permissions Manager",
+            "users": [{"user": self.test_user}, {"user": self.test_user}],
+            "user_permission_manager_mapper": [{
+                "allow": "Note",
+                "for_value": self.note.name,
+                "apply_to_all_doctypes": 1
+            }]
+        })
+        self.assertEqual(doc.get_user_list(), [self.test_user])
+
+        doc.append("users", {"user": self.second_user})
+        self.assertEqual(doc.get_user_list(), [self.test_user])
+
+        doc.invalidate_user_list()
+        self.assertEqual(doc.get_user_list(), [self.test_user, self.second_user])
+
+    def test_removed_row_cleaned_up_on_update(self):
+        another_note = frappe.get_doc({
+            "doctype": "Note",
+            "title": "Another Note",
+            "content": "Note 2"
+        }).insert()
+        doc = frappe.get_doc({
+            "doctype": "User Permissions Manager",
+            "users": [{"user": self.test_user}],
+            "user_permission_manager_mapper": [
+                {
+                    "allow": "Note",
+                    "for_value": self.note.name,
+                    "apply_to_all_doctypes": 1
+                },
+                {
+                    "allow": "Note",
+                    "for_value": another_note.name,
+                    "apply_to_all_doctypes": 1
+                }
+            ]
+        }).insert()
+
+        doc.user_permission_manager_mapper.pop()
+        doc.append("users", {"user": self.second_user})
+        doc.save()
+
+        self.assertFalse(frappe.db.exists("User Permission", {
+            "user": self.test_user,
+            "for_value": another_note.name
+        }))
+        self.assertTrue(frappe.db.exists("User Permission", {
+            "user": self.second_user,
+            "for_value": self.note.name
+        }))
+        self.assertFalse(frappe.db.exists("User Permission", {
+            "user": self.second_user,
+            "for_value": another_note.name
+        }))
+
+    def test_role_change_syncs_role_based_manager(self):
+        role = "Test Permissions Manager Role"
+        if not frappe.db.exists("Role", role):
+            frappe.get_doc({"doctype": "Role", "role_name": role}).insert()
+        frappe.get_doc("User", self.second_user).add_roles(role)
+
+        frappe.get_doc({
+            "doctype": "User Permissions Manager",
+            "roles": [{"role": role}],
+            "apply_to_role": 1,
+            "user_permission_manager_mapper": [{
+                "allow": "Note",
+                "for_value": self.note.name,
+                "apply_to_all_doctypes": 1
+            }]
+        }).insert()
+        self.assertFalse(frappe.db.exists("User Permission", {"user": self.test_user, "for_value": self.note.name}))
+
+        user = frappe.get_doc("User", self.test_user)
+        user.add_roles(role)
+        self.assertTrue(frappe.db.exists("User Permission", {"user": self.test_user, "for_value": self.note.name}))
+
+        user.remove_roles(role)
+        self.assertFalse(frappe.db.exists("User Permission", {"user": self.test_user, "for_value": self.note.name}))
+        self.assertTrue(frappe.db.exists("User Permission", {"user": self.second_user, "for_value": self.note.name}))
+
+    def test_shared_permission_kept_until_last_manager_removed(self):
+        rows = [{
+            "allow": "Note",
+            "for_value": self.note.name,
+            "apply_to_all_doctypes": 1
+        }]
+        first = frappe.get_doc({
+            "doctype": "User Permissions Manager",
+            "users": [{"user": self.test_user}],
+            "user_permission_manager_mapper": rows
+        }).insert()
+        second = frappe.get_doc({
+            "doctype": "User Permissions Manager",
+            "users": [{"user": self.test_user}],
+            "user_permission_manager_mapper": rows
+        }).insert()
+
+        self.assertEqual(delete_user_permissions(first.name), 0)
+        self.assertTrue(frappe.db.exists("User Permission", {"user": self.test_user, "for_value": self.note.name}))
+
+        self.assertEqual(delete_user_permissions(second.name), 1)
+        self.assertFalse(frappe.db.exists("User Permission", {"user": self.test_user, "for_value": self.note.name}))
+
+    def test_manually_created_permission_not_removed(self):
+        frappe.get_doc({
+            "doctype": "User Permission",
+            "user": self.test_user,
+            "allow": "Note",
+            "for_value": self.note.name,
+            "apply_to_all_doctypes": 1
+        }).insert()
+        doc = frappe.get_doc({
+            "doctype": "User Permissions Manager",
+            "users": [{"user": self.test_user}],
+            "user_permission_manager_mapper": [{
+                "allow": "Note",
+                "for_value": self.note.name,
+                "apply_to_all_doctypes": 1
+            }]
+        }).insert()
+
+        self.assertEqual(delete_user_permissions(doc.name), 0)
+        self.assertTrue(frappe.db.exists("User Permission", {"user": self.test_user, "for_value": self.note.name}))
+
+    def test_apply_returns_and_logs_metrics(self):
+        doc = frappe.get_doc({
+            "doctype": "User Permissions Manager",
+            "users": [{"user": self.test_user}, {"user": self.second_user}],
+            "user_permission_manager_mapper": [{
+                "allow": "Note",
+                "for_value": self.note.name,
+                "apply_to_all_doctypes": 1
+            }]
+        }).insert()
+        frappe.db.delete("User Permission", {"user": self.second_user})
+
+        metrics = apply_bulk_user_permissions(doc.name)["metrics"]
+
+        self.assertEqual(metrics["inserted"], 1)
+        self.assertEqual(metrics["skipped"], 1)
+        self.assertEqual(metrics["users_invalidated"], 1)
+        self.assertTrue({"lookup", "planning", "insert", "cache_refresh"} <= set(metrics["stages"]))
+        self.assertTrue(frappe.db.exists("User Permissions Manager Log", {"manager": doc.name, "operation": "Apply"}))
+
+    def test_preview_reports_changes_without_writing(self):
+        another_note = frappe.get_doc({
+            "doctype": "Note",
+            "title": "Another Note",
+            "content": "Note 2"
+        }).insert()
+        doc = frappe.get_doc({
+            "doctype": "User Permissions Manager",
+            "users": [{"user": self.test_user}],
+            "user_permission_manager_mapper": [{
+                "allow": "Note",
+                "for_value": self.note.name,
+                "apply_to_all_doctypes": 1
+            }]
+        }).insert()
+
+        doc.user_permission_manager_mapper[0].for_value = another_note.name
+        doc.append("users", {"user": self.second_user})
+        preview = preview_user_permissions(doc.as_dict())
+
+        self.assertEqual(preview["insert"]["count"], 2)
+        self.assertEqual(preview["delete"]["count"], 1)
+        self.assertEqual(preview["conflict"]["count"], 0)
+        self.assertEqual(frappe.db.count("User Permission", {"user": ["in", [self.test_user, self.second_user]]}), 1)
+
+    def test_default_conflict_with_other_manager_blocked(self):
+        another_note = frappe.get_doc({
+            "doctype": "Note",
+            "title": "Another Note",
+            "content": "Note 2"
+        }).insert()
+        frappe.get_doc({
+            "doctype": "User Permissions Manager",
+            "users": [{"user": self.test_user}],
+            "user_permission_manager_mapper": [{
+                "allow": "Note",
+                "for_value": self.note.name,
+                "apply_to_all_doctypes": 1,
+                "is_default": 1
+            }]
+        }).insert()
+
+        doc = frappe.get_doc({
+            "doctype": "User Permissions Manager",
+            "users": [{"user": self.test_user}],
+            "user_permission_manager_mapper": [{
+                "allow": "Note",
+                "for_value": another_note.name,
+                "apply_to_all_doctypes": 1,
+                "is_default": 1
+            }]
+        })
+        with self.assertRaises(frappe.ValidationError):
+            doc.insert()
+
+    def test_import_groups_lines_per_user(self):
+        lines = [
+            {"user": self.test_user, "allow": "Note", "for_value": self.note.name, "applicable_for": "ToDo"},
+            {"user": self.test_user, "allow": "Note", "for_value": self.note.name, "applicable_for": "Event"},
+            {"user": self.second_user, "allow": "Note", "for_value": self.note.name},
+            {"user": self.second_user, "allow": "Note", "for_value": "Missing Note"},
+        ]
+
+        result = import_lines(iter(lines), "Test Import", chunk_size=2)
+
+        self.assertEqual(result["imported"], 3)
+        self.assertEqual(result["invalid"], 1)
+        self.assertEqual(get_paged_rows(f"Test Import: {self.test_user}")["total"], 2)
+        self.assertEqual(frappe.db.count("User Permission", {"user": self.test_user, "for_value": self.note.name}), 2)
+        self.assertTrue(frappe.db.exists("User Permission", {
+            "user": self.second_user,
+            "for_value": self.note.name,
+            "apply_to_all_doctypes": 1
+        }))
+
+    def test_batch_apply_writes_shared_entries_once(self):
+        rows = [{
+            "allow": "Note",
+            "for_value": self.note.name,
+            "apply_to_all_doctypes": 1
+        }]
+        names = [
+            frappe.get_doc({
+                "doctype": "User Permissions Manager",
+                "users": [{"user": self.test_user}, {"user": self.second_user}],
+                "user_permission_manager_mapper": rows
+            }).insert().name
+            for i in range(2)
+        ]
+        frappe.db.delete("User Permission", {"user": ["in", [self.test_user, self.second_user]]})
+        frappe.db.delete("User Permission Provenance")
+
+        result = apply_bulk_user_permissions_batch(names)
+
+        self.assertEqual(result["metrics"]["inserted"], 2)
+        self.assertEqual(frappe.db.count("User Permission", {"user": self.test_user, "for_value": self.note.name}), 1)
+        self.assertEqual(delete_user_permissions(names[0]), 0)
+        self.assertEqual(delete_user_permissions(names[1]), 2)
+
+    def test_batch_apply_combines_rows_of_managers_sharing_a_value(self):
+        names = [
+            frappe.get_doc({
+                "doctype": "User Permissions Manager",
+                "users": [{"user": self.test_user}],
+                "user_permission_manager_mapper": [row]
+            }).insert().name
+            for row in (
+                {"allow": "Note", "for_value": self.note.name, "apply_to_all_doctypes": 1},
+                {"allow": "Note", "for_value": self.note.name, "apply_to_all_doctypes": 0,
+                 "applicable_for": "ToDo", "is_default": 1},
+            )
+        ]
+        frappe.db.delete("User Permission", {"user": self.test_user})
+        frappe.db.delete("User Permission Provenance")
+
+        apply_bulk_user_permissions_batch(names)
+
+        permissions = frappe.get_all(
+            "User Permission",
+            filters={"user": self.test_user, "for_value": self.note.name},
+            fields=["apply_to_all_doctypes", "applicable_for", "is_default"]
+        )
+        self.assertEqual([tuple(p.values()) for p in permissions], [(0, "ToDo", 1)])
+
+    def test_reconcile_reports_and_repairs_drift(self):
+        doc = frappe.get_doc({
+            "doctype": "User Permissions Manager",
+            "users": [{"user": self.test_user}, {"user": self.second_user}],
+            "user_permission_manager_mapper": [{
+                "allow": "Note",
+                "for_value": self.note.name,
+                "apply_to_all_doctypes": 1
+            }]
+        }).insert()
+        frappe.db.delete("User Permission", {"user": self.test_user})
+        frappe.db.delete("User Permissions Manager Child User", {"parent": doc.name, "user": self.second_user})
+
+        report = reconcile_user_permissions()
+        self.assertEqual(report["missing"], 1)
+        self.assertEqual(report["orphaned"], 1)
+        self.assertTrue(frappe.db.exists("User Permission", {"user": self.second_user}))
+
+        reconcile_user_permissions(mode="repair")
+        self.assertTrue(frappe.db.exists("User Permission", {"user": self.test_user, "for_value": self.note.name}))
+        self.assertFalse(frappe.db.exists("User Permission", {"user": self.second_user}))
+        self.assertEqual(reconcile_user_permissions()["missing"], 0)
+
+    def test_effective_value_counts_include_other_permissions(self):
+        another_note = frappe.get_doc({
+            "doctype": "Note",
+            "title": "Another Note",
+            "content": "Note 2"
+        }).insert()
+        frappe.get_doc({
+            "doctype": "User Permission",
+            "user": self.test_user,
+            "allow": "Note",
+            "for_value": another_note.name,
+            "apply_to_all_doctypes": 1
+        }).insert()
+        doc = frappe.get_doc({
+            "doctype": "User Permissions Manager",
+            "users": [{"user": self.test_user}, {"user": self.second_user}],
+            "user_permission_manager_mapper": [{
+                "allow": "Note",
+                "for_value": self.note.name,
+                "apply_to_all_doctypes": 1
+            }]
+        }).insert()
+
+        counts = get_effective_value_counts(doc.name)
+
+        self.assertEqual(counts["rows"][0]["count"], 1)
+        self.assertEqual(counts["users"][self.test_user]["Note"], 2)
+        self.assertEqual(counts["users"][self.second_user]["Note"], 1)
+
+    def test_filter_rule_expands_and_follows_new_records(self):
+        note_a = frappe.get_doc({"doctype": "Note", "title": "Note A", "content": "A"}).insert()
+        frappe.get_doc({
+            "doctype": "User Permissions Manager",
+            "users": [{"user": self.test_user}],
+            "user_permission_manager_mapper": [{
+                "allow": "Note",
+                "rule_type": "Filter",
+                "value_filters": '{"title": ["in", ["Note A", "Note B"]]}',
+                "apply_to_all_doctypes": 1
+            }]
+        }).insert()
+        self.assertTrue(frappe.db.exists("User Permission", {"user": self.test_user, "for_value": note_a.name}))
+        self.assertFalse(frappe.db.exists("User Permission", {"user": self.test_user, "for_value": self.note.name}))
+
+        note_b = frappe.get_doc({"doctype": "Note", "title": "Note B", "content": "B"}).insert()
+        self.assertTrue(frappe.db.exists("User Permission", {"user": self.test_user, "for_value": note_b.name}))
+
+    def test_apply_by_name_reads_projected_rows(self):
+        doc = frappe.get_doc({
+            "doctype": "User Permissions Manager",
+            "users": [{"user": self.test_user}],
+            "user_permission_manager_mapper": [{
+                "allow": "Note",
+                "for_value": self.note.name,
+                "apply_to_all_doctypes": 0,
+                "applicable_for": "ToDo"
+            }]
+        }).insert()
+        frappe.db.delete("User Permission", {"user": self.test_user})
+
+        apply_bulk_user_permissions(doc.name)
+
+        self.assertTrue(frappe.db.exists("User Permission", {
+            "user": self.test_user,
+            "for_value": self.note.name,
+            "applicable_for": "ToDo"
+        }))
+        with self.assertRaises(frappe.DoesNotExistError):
+            apply_bulk_user_permissions("Missing Manager")
+
+    def test_background_sync_commits_in_chunks_and_clears_checkpoint(self):
+        doc = frappe.get_doc({
+            "doctype": "User Permissions Manager",
+            "users": [{"user": self.test_user}, {"user": self.second_user}],
+            "user_permission_manager_mapper": [{
+                "allow": "Note",
+                "for_value": self.note.name,
+                "apply_to_all_doctypes": 1
+            }]
+        }).insert()
+        frappe.db.delete("User Permission", {"user": ["in", [self.test_user, self.second_user]]})
+        frappe.db.set_value("User Permissions Manager", doc.name, "apply_checkpoint", self.second_user)
+
+        frappe.conf.user_permissions_manager_commit_interval = 1
+        try:
+            run_permission_sync(
+                doc.name, {"clear": [], "apply": [([self.test_user], get_manager_rows(doc.name))]}, resume=True
+            )
+        finally:
+            frappe.conf.pop("user_permissions_manager_commit_interval")
+
+        self.assertTrue(frappe.db.exists("User Permission", {"user": self.test_user, "for_value": self.note.name}))
+        self.assertFalse(frappe.db.exists("User Permission", {"user": self.second_user}))
+        self.assertEqual(
+            frappe.db.get_value("User Permissions Manager", doc.name, ["status", "apply_checkpoint"]),
+            ("Done", None)
+        )
+
+    def test_concurrently_planned_inserts_write_one_row(self):
+        rows = [frappe._dict({
+            "allow": "Note",
+            "for_value": self.note.name,
+            "apply_to_all_doctypes": 1,
+            "applicable_for": None,
+            "is_default": 0,
+            "hide_descendants": 0
+        })]
+        first = plan_user_permissions(rows, [self.test_user])["insert"]
+        second = plan_user_permissions(rows, [self.test_user])["insert"]
+
+        write_user_permissions(first)
+        write_user_permissions(second)
+
+        self.assertEqual(frappe.db.count("User Permission", {"user": self.test_user, "for_value": self.note.name}), 1)
+
+    def test_apply_releases_locks_between_user_chunks(self):
+        doc = frappe.get_doc({
+            "doctype": "User Permissions Manager",
+            "users": [{"user": self.test_user}, {"user": self.second_user}],
+            "user_permission_manager_mapper": [{
+                "allow": "Note",
+                "for_value": self.note.name,
+                "apply_to_all_doctypes": 1
+            }]
+        }).insert()
+        frappe.db.delete("User Permission", {"user": ["in", [self.test_user, self.second_user]]})
+        rows = get_manager_rows(doc.name)
+        users = [self.test_user, self.second_user]
+        progress = []
+
+        def lock_all(done, total):
+            # Fails at once if the finished chunk still held its locks
+            with permission_locks([(users, rows)]):
+                progress.append((done, total))
+
+        with patch(f"{MODULE}.LOCK_CHUNK_SIZE", 1), patch(f"{MODULE}.LOCK_WAIT", 0):
+            apply_permission_delta({"clear": [], "apply": [(users, rows)]}, doc.name, progress=lock_all)
+
+        self.assertEqual(progress, [(1, 2), (2, 2)])
+        self.assertEqual(frappe.db.count("User Permission", {"user": ["in", users], "for_value": self.note.name}), 2)
+
+    def test_bulk_write_limited_to_system_manager(self):
+        rows = [frappe._dict({
+            "allow": "Note",
+            "for_value": self.note.name,
+            "apply_to_all_doctypes": 1,
+            "applicable_for": None,
+            "is_default": 0,
+            "hide_descendants": 0
+        })]
+        entries = plan_user_permissions(rows, [self.test_user])["insert"]
+
+        frappe.set_user(self.second_user)
+        try:
+            self.assertRaises(frappe.PermissionError, write_user_permissions, entries)
+        finally:
+            frappe.set_user("Administrator")
+        self.assertFalse(frappe.db.exists("User Permission", {"user": self.test_user, "for_value": self.note.name}))
+
+    def test_partitioned_sync_sets_status_when_last_partition_finishes(self):
+        doc = frappe.get_doc({
+            "doctype": "User Permissions Manager",
+            "users": [{"user": self.test_user}, {"user": self.second_user}],
+            "user_permission_manager_mapper": [{
+                "allow": "Note",
+                "for_value": self.note.name,
+                "apply_to_all_doctypes": 1
+            }]
+        }).insert()
+        frappe.db.delete("User Permission", {"user": ["in", [self.test_user, self.second_user]]})
+        frappe.db.set_value("User Permissions Manager", doc.name, "status", "Queued")
+        rows = get_manager_rows(doc.name)
+
+        run_permission_partition(
+            doc.name, "test-run", 2, [self.second_user], {"clear": [], "apply": [([self.second_user], rows)]}
+        )
+        self.assertEqual(frappe.db.get_value("User Permissions Manager", doc.name, "status"), "Running")
+
+        run_permission_partition(
+            doc.name, "test-run", 2, [self.test_user], {"clear": [], "apply": [([self.test_user], rows)]}
+        )
+        self.assertEqual(frappe.db.get_value("User Permissions Manager", doc.name, "status"), "Done")
+        self.assertEqual(frappe.db.count("User Permission", {"user": ["in", [self.test_user, self.second_user]]}), 2)
+
+    def test_partitions_run_concurrently_on_disjoint_locks(self):
+        doc = frappe.get_doc({
+            "doctype": "User Permissions Manager",
+            "users": [{"user": self.test_user}, {"user": self.second_user}],
+            "user_permission_manager_mapper": [{
+                "allow": "Note",
+                "for_value": self.note.name,
+                "apply_to_all_doctypes": 1
+            }]
+        }).insert()
+        frappe.db.delete("User Permission", {"user": ["in", [self.test_user, self.second_user]]})
+        # Left by an earlier single-job run that failed
+        frappe.db.set_value("User Permissions Manager", doc.name, "apply_checkpoint", self.second_user)
+        users = [self.test_user, self.second_user]
+        rows = get_manager_rows(doc.name)
+
+        jobs = []
+        frappe.conf.user_permissions_manager_partitions = 2
+        try:
+            with patch(f"{MODULE}.PARTITION_MIN_USERS", 1), patch(
+                "frappe.enqueue", lambda method, **kwargs: jobs.append(kwargs)
+            ):
+                enqueue_permission_jobs(doc.name, users, {"clear": [], "apply": [(users, rows)]})
+        finally:
+            frappe.conf.pop("user_permissions_manager_partitions")
+        self.assertEqual(sorted(user for job in jobs for user in job["users"]), sorted(users))
+        self.assertIsNone(frappe.db.get_value("User Permissions Manager", doc.name, "apply_checkpoint"))
+
+        first, second = (
+            {key: job[key] for key in ("docname", "run_id", "partitions", "users", "delta")} for job in jobs
+        )
+        with patch(f"{MODULE}.LOCK_WAIT", 0):
+            # The second partition runs while the first holds its locks
+            with permission_locks(first["delta"]["apply"]):
+                run_permission_partition(**second)
+            run_permission_partition(**first)
+
+        self.assertEqual(frappe.db.get_value("User Permissions Manager", doc.name, "status"), "Done")
+        self.assertEqual(frappe.db.count("User Permission", {"user": ["in", users], "for_value": self.note.name}), 2)
+
+    def test_paged_manager_applies_each_edit_incrementally(self):
+        other = frappe.get_doc({"doctype": "Note", "title": "Another Note", "content": "Other"}).insert()
+        doc = frappe.get_doc({
+            "doctype": "User Permissions Manager",
+            "paged_mode": 1,
+            "users": [{"user": self.test_user}],
+            "user_permission_manager_mapper": [{
+                "allow": "Note",
+                "for_value": self.note.name,
+                "apply_to_all_doctypes": 1
+            }]
+        }).insert()
+
+        doc.reload()
+        self.assertFalse(doc.user_permission_manager_mapper)
+        self.assertFalse(doc.users)
+        self.assertEqual(get_paged_rows(doc.name)["total"], 1)
+        self.assertTrue(frappe.db.exists("User Permission", {"user": self.test_user, "for_value": self.note.name}))
+
+        upsert_paged_rows(doc.name, [{"allow": "Note", "for_value": other.name, "apply_to_all_doctypes": 1}])
+        self.assertTrue(frappe.db.exists("User Permission", {"user": self.test_user, "for_value": other.name}))
+
+        first = get_paged_rows(doc.name)["rows"][0]
+        delete_paged_rows(doc.name, [first.name])
+        self.assertFalse(frappe.db.exists("User Permission", {"user": self.test_user, "for_value": self.note.name}))
+
+        add_paged_users(doc.name, [self.second_user])
+        self.assertEqual(get_paged_rows(doc.name, table="users")["total"], 2)
+        self.assertTrue(frappe.db.exists("User Permission", {"user": self.second_user, "for_value": other.name}))
+        self.assertFalse(frappe.db.exists("User Permission", {"user": self.second_user, "for_value": self.note.name}))
+
+    def test_paged_save_writes_only_changed_users(self):
+        doc = frappe.get_doc({
+            "doctype": "User Permissions Manager",
+            "paged_mode": 1,
+            "users": [{"user": self.test_user}],
+            "user_permission_manager_mapper": [{
+                "allow": "Note",
+                "for_value": self.note.name,
+                "apply_to_all_doctypes": 1
+            }]
+        }).insert()
+        first = get_paged_rows(doc.name, "users")["rows"][0]
+
+        doc.reload()
+        doc.append("users", {"user": self.second_user})
+        doc.save()
+
+        rows = get_paged_rows(doc.name, "users")["rows"]
+        self.assertEqual([row.user for row in rows], [self.test_user, self.second_user])
+        self.assertEqual(rows[0].name, first.name)
+        self.assertTrue(frappe.db.exists("User Permission", {"user": self.second_user, "for_value": self.note.name}))
+
+    def test_applicable_for_lists_cached_until_metadata_changes(self):
+        invalidate_applicable_for(None)
+        result = get_applicable_for_doctypes(["Note", "ToDo", "Note"])
+        self.assertEqual(list(result), ["Note", "ToDo"])
+        self.assertIn("Note", result["Note"])
+        self.assertEqual(frappe.cache.hget(APPLICABLE_FOR_CACHE_KEY, "ToDo"), result["ToDo"])
+
+        frappe.cache.hset(APPLICABLE_FOR_CACHE_KEY, "Note", ["Cached"])
+        self.assertEqual(get_applicable_for_doctypes(["Note"])["Note"], ["Cached"])
+
+        invalidate_applicable_for(frappe.get_doc("DocType", "Note"), "on_update")
+        self.assertEqual(get_applicable_for_doctypes(["Note"])["Note"], result["Note"])
+
+    def test_background_cleanup_after_delete_releases_permissions(self):
+        doc = frappe.get_doc({
+            "doctype": "User Permissions Manager",
+            "users": [{"user": self.test_user}, {"user": self.second_user}],
+            "user_permission_manager_mapper": [{
+                "allow": "Note",
+                "for_value": self.note.name,
+                "apply_to_all_doctypes": 1
+            }]
+        }).insert()
+
+        frappe.conf.user_permissions_manager_background_threshold = 1
+        try:
+            doc.delete()
+        finally:
+            frappe.conf.pop("user_permissions_manager_background_threshold")
+        self.assertTrue(frappe.db.exists("User Permission", {"user": self.test_user, "for_value": self.note.name}))
+
+        run_permission_cleanup(doc.name, [self.test_user, self.second_user])
+
+        self.assertFalse(frappe.db.exists("User Permission", {"user": ["in", [self.test_user, self.second_user]]}))
+        self.assertTrue(frappe.db.exists("User Permissions Manager Log", {"manager": doc.name, "operation": "Trash"}))
+
+    def test_import_reports_lines_with_extra_values(self):
+        path = frappe.get_site_path("private", "files", "test_user_permission_import.csv")
+        with open(path, "w", newline="") as f:
+            f.write(f"User,DocType,Value\n{self.test_user},Note,{self.note.name},extra\n\n{self.test_user},Note,{self.note.name}\n")
+        try:
+            result = import_lines(read_lines(path), "Import Test")
+        finally:
+            os.remove(path)
+
+        self.assertEqual((result["imported"], result["invalid"]), (1, 1))
+        self.assertIn("Line 2", result["errors"][0])
+
+    def test_import_appends_only_new_rows(self):
+        other = frappe.get_doc({"doctype": "Note", "title": "Another Note", "content": "Other"}).insert()
+        import_lines(iter([
+            {"user": self.test_user, "allow": "Note", "for_value": self.note.name, "applicable_for": "ToDo"},
+        ]), "Test Import")
+
+        result = import_lines(iter([
+            {"user": self.test_user, "allow": "Note", "for_value": self.note.name, "applicable_for": "ToDo"},
+            {"user": self.test_user, "allow": "Note", "for_value": self.note.name},
+            {"user": self.test_user, "allow": "Note", "for_value": other.name},
+        ]), "Test Import")
+
+        self.assertEqual((result["imported"], result["skipped"], result["invalid"]), (1, 1, 1))
+        self.assertEqual(get_paged_rows(f"Test Import: {self.test_user}")["total"], 2)
+        self.assertTrue(frappe.db.exists("User Permission", {"user": self.test_user, "for_value": other.name}))
+        self.assertTrue(frappe.db.exists("User Permission", {
+            "user": self.test_user,
+            "for_value": self.note.name,
+            "applicable_for": "ToDo"
+        }))
+
+    def test_batch_apply_resolves_role_members_afresh(self):
+        role = "Test Batch Apply Role"
+        if not frappe.db.exists("Role", role):
+            frappe.get_doc({"doctype": "Role", "role_name": role}).insert()
+        doc = frappe.get_doc({
+            "doctype": "User Permissions Manager",
+            "apply_to_role": 1,
+            "roles": [{"role": role}],
+            "user_permission_manager_mapper": [{
+                "allow": "Note",
+                "for_value": self.note.name,
+                "apply_to_all_doctypes": 1
+            }]
+        }).insert()
+
+        # Role granted without a User save, so no hook updates the stored users
+        frappe.get_doc({
+            "doctype": "Has Role", "parent": self.test_user, "parenttype": "User", "parentfield": "roles", "role": role
+        }).db_insert()
+        apply_bulk_user_permissions_batch([doc.name])
+
+        self.assertTrue(frappe.db.exists("User Permission", {"user": self.test_user, "for_value": self.note.name}))
+
+    def test_managed_doctypes_follow_manager_rows(self):
+        get_managed_doctypes()
+        doc = frappe.get_doc({
+            "doctype": "User Permissions Manager",
+            "users": [{"user": self.test_user}],
+            "user_permission_manager_mapper": [{
+                "allow": "Note",
+                "for_value": self.note.name,
+                "apply_to_all_doctypes": 1
+            }]
+        }).insert()
+        self.assertIn("Note", get_managed_doctypes())
+
+        doc.delete()
+        self.assertNotIn("Note", get_managed_doctypes())
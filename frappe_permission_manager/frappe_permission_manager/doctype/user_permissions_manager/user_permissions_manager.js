@@ -1,5 +1,50 @@
+const PAGED_ROWS_PAGE_LENGTH = 50;
+
 frappe.ui.form.on("User Permissions Manager", {
+    setup(frm) {
+        frappe.realtime.on("user_permissions_manager_progress", (data) => {
+            if (data.status === "Running") {
+                const percent = data.total ? (data.done / data.total) * 100 : 0;
+                frm.dashboard.show_progress(
+                    __("Applying User Permissions"),
+                    percent,
+                    __("{0} of {1} user(s) processed", [data.done, data.total])
+                );
+                return;
+            }
+
+            frm.dashboard.hide_progress(__("Applying User Permissions"));
+            if (data.status === "Failed") {
+                frappe.msgprint(__("Applying User Permissions failed. Check the Error Log for details."));
+            } else if (data.errors && data.errors.length) {
+                frappe.msgprint(__("Some errors occurred:<br>") + data.errors.join("<br>"));
+            }
+            frm.reload_doc();
+        });
+    },
+
     refresh(frm) {
+        if (["Queued", "Running"].includes(frm.doc.status)) {
+            frm.dashboard.set_headline(__("User Permissions are being applied in the background."), "blue");
+        }
+
+        if (!frm.is_new()) {
+            frm.add_custom_button(__("Effective Access"), () => frm.events.show_effective_access(frm));
+        }
+
+        if (frm.doc.status === "Failed") {
+            frm.add_custom_button(__("Resume Apply"), () => {
+                frappe.call({
+                    method: "frappe_permission_manager.frappe_permission_manager.doctype.user_permissions_manager.user_permissions_manager.resume_user_permissions",
+                    args: { docname: frm.doc.name },
+                }).then(() => frm.reload_doc());
+            });
+        }
+
+        if (frm.doc.paged_mode && !frm.is_new()) {
+            frm.events.render_paged_rows(frm);
+        }
+
         frm.set_query("users", function() {
             let roles_list = (frm.doc.roles || []).map(d => d.role);
             return {
@@ -9,6 +54,223 @@ frappe.ui.form.on("User Permissions Manager", {
         });
     },
 
+    before_save(frm) {
+        return frappe.call({
+            method: "frappe_permission_manager.frappe_permission_manager.doctype.user_permissions_manager.user_permissions_manager.preview_user_permissions",
+            args: { doc: frm.doc },
+            freeze: true,
+            freeze_message: __("Previewing User Permissions..."),
+        }).then((r) => {
+            const preview = r.message;
+            if (!preview.insert.count && !preview.delete.count && !preview.conflict.count) {
+                return;
+            }
+
+            return new Promise((resolve) => {
+                frappe.confirm(
+                    frm.events.get_preview_html(preview),
+                    () => resolve(),
+                    () => {
+                        frappe.validated = false;
+                        resolve();
+                    }
+                );
+            });
+        });
+    },
+
+    render_paged_rows(frm) {
+        const wrapper = $(frm.fields_dict.paged_rows_html.wrapper).empty();
+        const tables = [{
+            table: "mapper",
+            label: __("Assign Permissions"),
+            columns: ["allow", "for_value", "value_filters", "applicable_for", "is_default"],
+            key: "name",
+        }];
+        if (!frm.doc.apply_to_role) {
+            tables.unshift({ table: "users", label: __("Users"), columns: ["user"], key: "user" });
+        }
+
+        tables.forEach((table) => {
+            table.start = 0;
+            table.$wrapper = $(`<div class="paged-rows" style="margin-bottom: 20px;"></div>`).appendTo(wrapper);
+            frm.events.load_paged_rows(frm, table);
+        });
+    },
+
+    load_paged_rows(frm, table) {
+        frappe.call({
+            method: "frappe_permission_manager.frappe_permission_manager.paged_rows.get_paged_rows",
+            args: { docname: frm.doc.name, table: table.table, start: table.start, page_length: PAGED_ROWS_PAGE_LENGTH },
+        }).then((r) => {
+            const { rows, total } = r.message;
+            const end = Math.min(table.start + rows.length, total);
+            const header = table.columns.map(c => `<th>${__(frappe.unscrub(c))}</th>`).join("");
+            const body = rows.map(row =>
+                `<tr data-name="${frappe.utils.escape_html(row[table.key])}">`
+                + table.columns.map(c => `<td>${frappe.utils.escape_html(row[c] == null ? "" : String(row[c]))}</td>`).join("")
+                + `<td class="text-right">`
+                + (table.table === "mapper" ? `<button class="btn btn-xs btn-default edit-row">${__("Edit")}</button> ` : "")
+                + `<button class="btn btn-xs btn-danger delete-row">${__("Delete")}</button></td></tr>`
+            ).join("");
+
+            table.$wrapper.html(`
+                <div class="flex justify-between align-center" style="margin-bottom: 8px;">
+                    <b>${table.label}</b>
+                    <span class="text-muted">${__("{0} to {1} of {2}", [total ? table.start + 1 : 0, end, total])}</span>
+                </div>
+                <table class="table table-bordered table-sm">
+                    <thead><tr>${header}<th></th></tr></thead>
+                    <tbody>${body}</tbody>
+                </table>
+                <div>
+                    <button class="btn btn-xs btn-default add-row">${__("Add")}</button>
+                    <button class="btn btn-xs btn-default prev-page" ${table.start ? "" : "disabled"}>${__("Previous")}</button>
+                    <button class="btn btn-xs btn-default next-page" ${end < total ? "" : "disabled"}>${__("Next")}</button>
+                </div>`);
+
+            table.$wrapper.find(".prev-page").on("click", () => {
+                table.start = Math.max(table.start - PAGED_ROWS_PAGE_LENGTH, 0);
+                frm.events.load_paged_rows(frm, table);
+            });
+            table.$wrapper.find(".next-page").on("click", () => {
+                table.start += PAGED_ROWS_PAGE_LENGTH;
+                frm.events.load_paged_rows(frm, table);
+            });
+            table.$wrapper.find(".add-row").on("click", () => frm.events.edit_paged_row(frm, table));
+            table.$wrapper.find(".edit-row").on("click", (e) => {
+                const name = $(e.currentTarget).closest("tr").attr("data-name");
+                frm.events.edit_paged_row(frm, table, rows.find(row => row.name === name));
+            });
+            table.$wrapper.find(".delete-row").on("click", (e) => {
+                const key = $(e.currentTarget).closest("tr").attr("data-name");
+                frappe.confirm(__("Delete this row and clear the User Permissions it gives?"), () => {
+                    frm.events.call_paged_endpoint(
+                        frm,
+                        table,
+                        table.table === "users" ? "remove_paged_users" : "delete_paged_rows",
+                        table.table === "users" ? { users: [key] } : { names: [key] }
+                    );
+                });
+            });
+        });
+    },
+
+    edit_paged_row(frm, table, row) {
+        if (table.table === "users") {
+            const dialog = new frappe.ui.Dialog({
+                title: __("Add Users"),
+                fields: [{
+                    fieldname: "users",
+                    fieldtype: "Table MultiSelect",
+                    label: __("Users"),
+                    options: "User Permissions Manager Child User",
+                    reqd: 1,
+                }],
+                primary_action_label: __("Add"),
+                primary_action(values) {
+                    dialog.hide();
+                    frm.events.call_paged_endpoint(frm, table, "add_paged_users", {
+                        users: values.users.map(d => d.user),
+                    });
+                },
+            });
+            dialog.show();
+            return;
+        }
+
+        const dialog = new frappe.ui.Dialog({
+            title: row ? __("Edit Row") : __("Add Row"),
+            fields: [
+                { fieldname: "allow", fieldtype: "Link", label: __("Allow"), options: "DocType", reqd: 1,
+                    get_query: () => ({ filters: { issingle: 0, istable: 0 } }),
+                    onchange: () => frm.events.load_applicable_for(frm, [dialog.get_value("allow")]) },
+                { fieldname: "rule_type", fieldtype: "Select", label: __("Rule Type"), options: "Value\nFilter", default: "Value" },
+                { fieldname: "for_value", fieldtype: "Dynamic Link", label: __("For Value"), options: "allow",
+                    depends_on: "eval:doc.rule_type !== 'Filter'", mandatory_depends_on: "eval:doc.rule_type !== 'Filter'" },
+                { fieldname: "value_filters", fieldtype: "Code", label: __("Value Filters"), options: "JSON",
+                    depends_on: "eval:doc.rule_type === 'Filter'", mandatory_depends_on: "eval:doc.rule_type === 'Filter'" },
+                { fieldname: "apply_to_all_doctypes", fieldtype: "Check", label: __("Apply To All Document Types"), default: 1 },
+                { fieldname: "applicable_for", fieldtype: "Link", label: __("Applicable For"), options: "DocType",
+                    depends_on: "eval:!doc.apply_to_all_doctypes", mandatory_depends_on: "eval:!doc.apply_to_all_doctypes",
+                    get_query: () => frm.events.get_applicable_for_query(frm, dialog.get_value("allow")) },
+                { fieldname: "is_default", fieldtype: "Check", label: __("Is Default"),
+                    depends_on: "eval:doc.rule_type !== 'Filter'" },
+                { fieldname: "hide_descendants", fieldtype: "Check", label: __("Hide Descendants") },
+            ],
+            primary_action_label: row ? __("Update") : __("Add"),
+            primary_action(values) {
+                dialog.hide();
+                frm.events.call_paged_endpoint(frm, table, "upsert_paged_rows", {
+                    rows: [Object.assign({}, values, row ? { name: row.name } : {})],
+                });
+            },
+        });
+        if (row) {
+            dialog.set_values(row);
+        }
+        dialog.show();
+    },
+
+    call_paged_endpoint(frm, table, method, args) {
+        frappe.call({
+            method: `frappe_permission_manager.frappe_permission_manager.paged_rows.${method}`,
+            args: Object.assign({ docname: frm.doc.name }, args),
+            freeze: true,
+            freeze_message: __("Applying User Permissions..."),
+        }).then(() => frm.events.load_paged_rows(frm, table));
+    },
+
+    show_effective_access(frm) {
+        frappe.call({
+            method: "frappe_permission_manager.frappe_permission_manager.descendants.get_effective_value_counts",
+            args: { docname: frm.doc.name },
+            freeze: true,
+        }).then((r) => {
+            const rows = r.message.rows.map(d =>
+                `<tr><td>${frappe.utils.escape_html(d.allow)}</td><td>${frappe.utils.escape_html(d.for_value)}</td><td>${d.count}</td></tr>`
+            ).join("");
+            const users = Object.entries(r.message.users).map(([user, counts]) =>
+                `<tr><td>${frappe.utils.escape_html(user)}</td><td>`
+                + Object.entries(counts).map(([allow, count]) => `${frappe.utils.escape_html(allow)}: ${count}`).join(", ")
+                + "</td></tr>"
+            ).join("");
+
+            frappe.msgprint({
+                title: __("Effective Access"),
+                wide: true,
+                message: `<table class="table table-bordered">
+                        <tr><th>${__("Allow")}</th><th>${__("For Value")}</th><th>${__("Records Granted")}</th></tr>${rows}
+                    </table>
+                    <table class="table table-bordered">
+                        <tr><th>${__("User")}</th><th>${__("Records Visible")}</th></tr>${users}
+                    </table>`,
+            });
+        });
+    },
+
+    get_preview_html(preview) {
+        const part = (label, data) => {
+            let html = `<p><b>${label}: ${data.count}</b></p>`;
+            if (data.sample.length) {
+                html += "<ul>" + data.sample.map(d =>
+                    `<li>${frappe.utils.escape_html(d.user)}: ${frappe.utils.escape_html(d.allow)} / ${frappe.utils.escape_html(d.for_value)}`
+                    + (d.applicable_for ? ` (${frappe.utils.escape_html(d.applicable_for)})` : "") + "</li>"
+                ).join("") + "</ul>";
+            }
+            return html;
+        };
+
+        let html = part(__("To insert"), preview.insert)
+            + part(__("To delete"), preview.delete)
+            + part(__("Conflicting defaults"), preview.conflict)
+            + `<p>${__("Already applied: {0}", [preview.skip.count])}</p>`;
+        if (preview.background) {
+            html += `<p>${__("This change will be applied in the background.")}</p>`;
+        }
+        return html + `<p>${__("Save and apply these changes?")}</p>`;
+    },
+
     onload(frm) {
         frm.fields_dict["user_permission_manager_mapper"].grid.get_field("allow").get_query = () => {
             return {
@@ -20,11 +282,34 @@ frappe.ui.form.on("User Permissions Manager", {
         };
 
         frm.fields_dict["user_permission_manager_mapper"].grid.get_field("applicable_for").get_query = (doc, cdt, cdn) => {
-            const row = locals[cdt][cdn];
-            return {
-                query: "frappe.core.doctype.user_permission.user_permission.get_applicable_for_doctype_list",
-                doctype: row.allow,
-            };
+            return frm.events.get_applicable_for_query(frm, locals[cdt][cdn].allow);
+        };
+
+        frm.events.load_applicable_for(frm, (frm.doc.user_permission_manager_mapper || []).map(row => row.allow));
+    },
+
+    load_applicable_for(frm, doctypes) {
+        // Applicable-for choices of every allow doctype in the grid, fetched in one request
+        frm.applicable_for = frm.applicable_for || {};
+        doctypes = [...new Set(doctypes.filter(d => d && !frm.applicable_for[d]))];
+        if (!doctypes.length) {
+            return Promise.resolve();
+        }
+
+        return frappe.call({
+            method: "frappe_permission_manager.frappe_permission_manager.api.get_applicable_for_doctypes",
+            args: { doctypes },
+        }).then((r) => Object.assign(frm.applicable_for, r.message));
+    },
+
+    get_applicable_for_query(frm, allow) {
+        const doctypes = (frm.applicable_for || {})[allow];
+        if (doctypes) {
+            return { filters: { name: ["in", doctypes] } };
+        }
+        return {
+            query: "frappe.core.doctype.user_permission.user_permission.get_applicable_for_doctype_list",
+            doctype: allow,
         };
     },
 });
@@ -35,10 +320,19 @@ frappe.ui.form.on("User Permissions Manager Child", {
         if (row.allow && row.for_value) {
             frappe.model.set_value(cdt, cdn, "for_value", null);
         }
+        frm.events.load_applicable_for(frm, [row.allow]);
 
         frappe.ui.form.trigger(cdt, cdn, "toggle_hide_descendants");
     },
 
+    rule_type: function (frm, cdt, cdn) {
+        const row = locals[cdt][cdn];
+        frappe.model.set_value(cdt, cdn, row.rule_type === "Filter" ? "for_value" : "value_filters", null);
+        if (row.rule_type === "Filter" && row.is_default) {
+            frappe.model.set_value(cdt, cdn, "is_default", 0);
+        }
+    },
+
     apply_to_all_doctypes: function (frm, cdt, cdn) {
         frappe.ui.form.trigger(cdt, cdn, "set_applicable_for_constraint");
     },
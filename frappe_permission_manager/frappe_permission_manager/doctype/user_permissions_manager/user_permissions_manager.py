@@ -1,21 +1,87 @@
 # Copyright (c) 2025, Dhwani RIS and contributors
 # License: MIT
 
+import hashlib
+import json
+from collections import defaultdict
+from contextlib import contextmanager
+
 import frappe
 from frappe import _
-from frappe.model.document import Document
 from frappe.core.doctype.user_permission.user_permission import (
     add_user_permissions,
     clear_user_permissions,
 )
-from collections import defaultdict
+from frappe.model.document import Document
+from frappe.utils import cint, cstr
+from redis.exceptions import LockError
+
+from frappe_permission_manager.frappe_permission_manager.instrumentation import OperationMetrics
+
+# Upper bound for the number of values passed to a single `IN (...)` clause
+QUERY_CHUNK_SIZE = 500
+# Default number of User Permission rows written per multi-row INSERT,
+# overridable with `user_permissions_manager_batch_size` in site config
+BULK_INSERT_BATCH_SIZE = 500
+# Saves expanding to more (users x mapper rows) than this run as a background
+# job, overridable with `user_permissions_manager_background_threshold`
+BACKGROUND_JOB_THRESHOLD = 5000
+BACKGROUND_JOB_TIMEOUT = 3600
+# Large background jobs are split over up to this many jobs on the long
+# queue, overridable with `user_permissions_manager_partitions`
+FANOUT_PARTITIONS = 4
+# Smallest number of users worth a job of its own
+PARTITION_MIN_USERS = 1000
+# Background applies commit after about this many (user x row) entries,
+# overridable with `user_permissions_manager_commit_interval`
+COMMIT_INTERVAL = 10000
+# (user, allow) pairs are guarded by this many Redis locks, so that
+# concurrent applies plan and write each user's permissions one at a time
+LOCK_STRIPES = 1024
+# Seconds to wait for a lock before giving up
+LOCK_WAIT = 120
+# Users whose locks are held while their permissions are planned and written;
+# locks are released between chunks so other applies can interleave
+LOCK_CHUNK_SIZE = 500
+# Users invalidated per HDEL and per realtime broadcast
+REFRESH_CHUNK_SIZE = 1000
+# Cached {role: [managers]} map of managers with `apply_to_role` set
+ROLE_INDEX_CACHE_KEY = "user_permissions_manager_role_index"
+# Cached {allow: [mapper rows]} map of filter rules, for the insert and rename hooks
+FILTER_RULE_INDEX_CACHE_KEY = "user_permissions_manager_filter_rule_index"
+# Doctypes any manager gives permissions on; site-wide document hooks return early for others
+MANAGED_DOCTYPES_CACHE_KEY = "user_permissions_manager_managed_doctypes"
+# Mapper columns read by the projected loaders
+MAPPER_FIELDS = [
+    "allow",
+    "rule_type",
+    "for_value",
+    "value_filters",
+    "apply_to_all_doctypes",
+    "applicable_for",
+    "is_default",
+    "hide_descendants",
+]
+# Rows of managers in paged mode are kept under these parentfields, which are not
+# in the doctype's meta, so they are neither loaded nor saved with the document
+PAGED_MAPPER_FIELD = "paged_mapper"
+PAGED_USERS_FIELD = "paged_users"
+MAPPER_PARENTFIELDS = ["user_permission_manager_mapper", PAGED_MAPPER_FIELD]
+USER_PARENTFIELDS = ["users", PAGED_USERS_FIELD]
+# Number of example entries returned per category by `preview_user_permissions`
+PREVIEW_SAMPLE_SIZE = 20
 
 
 class UserPermissionsManager(Document):
     def validate(self):
+        # Resolve role membership afresh for every save
+        self.invalidate_user_list()
         self.validate_strict_user_permission_enabled()
+        self.validate_paged_mode()
+        self.validate_filter_rules()
         self.validate_user_permission()
         self.validate_default_permission()
+        self.validate_cross_manager_conflicts()
         if self.apply_to_role and not self.roles:
             frappe.throw(_("You must select at least one role when 'Apply to Role' is checked."))
 
@@ -23,154 +89,1345 @@ class UserPermissionsManager(Document):
         if not frappe.db.get_single_value("System Settings", "apply_strict_user_permissions"):
             frappe.throw(_("Strict User Permissions is not enabled. Please enable it in System Settings."))
 
+    def validate_paged_mode(self):
+        if not self.paged_mode and not self.is_new() and self.has_value_changed("paged_mode"):
+            frappe.throw(_("Paged mode cannot be turned off once the rows are stored in pages."))
+
     def before_save(self):
+        if self.paged_mode:
+            # Rows still in the form are moved to the paged tables by `store_paged_rows`
+            self.flags.paged_rows = [row.as_dict() for row in self.user_permission_manager_mapper]
+            self.user_permission_manager_mapper = []
+            self.users = []
+
         if self.apply_to_role:
             roles = [r.role for r in self.roles or []]
             if not roles:
                 frappe.throw(_("No roles selected to populate users."))
 
-            users = frappe.get_all(
-                "Has Role",
-                filters = {
-                    "role": ["in", roles],
-                    "parenttype": "User"
-                },
-                fields=["parent as user"]
-            )
+            if self.paged_mode:
+                return
 
-            seen_users = set()
             self.users = []
-            for u in users:
-                if u.user not in seen_users:
-                    self.append("users", {"user": u.user})
-                    seen_users.add(u.user)
-                
-        if not self.is_new():
-            self._doc_before_save = frappe.get_doc(self.doctype, self.name)
+            for user in self.get_user_list():
+                self.append("users", {"user": user})
 
     def after_insert(self):
-        apply_bulk_user_permissions(self.name)
-        self._trigger_permission_refresh()
+        if self.paged_mode:
+            self.store_paged_rows()
+        self.sync_user_permissions()
 
     def on_update(self):
-        if hasattr(self, '_doc_before_save') and not self.is_new():
-            old_doc = self._doc_before_save
-            if old_doc:
-                previous_users = set([u.user for u in old_doc.users])
-                current_users = set(self.get_user_list())
-                removed_users = previous_users - current_users
-
-                # Remove only permissions that this doc had created for removed users
-                for user in removed_users:
-                    for row in old_doc.user_permission_manager_mapper:
-                        _safe_clear_permission_entry(user, row)
-
-        # Always delete and reapply for remaining users in this doc
-        # delete_user_permissions(self.name)
-        apply_bulk_user_permissions(self.name)
-        self._trigger_permission_refresh()
+        frappe.cache.delete_value([ROLE_INDEX_CACHE_KEY, FILTER_RULE_INDEX_CACHE_KEY, MANAGED_DOCTYPES_CACHE_KEY])
+        if self.flags.in_insert:
+            # after_insert has already applied the permissions of a new document
+            return
+
+        if self.paged_mode:
+            self.store_paged_rows()
+        self.sync_user_permissions(self.get_doc_before_save())
 
     def on_trash(self):
-        delete_user_permissions(self.name)
-        self._trigger_permission_refresh()
+        frappe.cache.delete_value([ROLE_INDEX_CACHE_KEY, FILTER_RULE_INDEX_CACHE_KEY, MANAGED_DOCTYPES_CACHE_KEY])
+        users = self.get_user_list()
+        rows = get_manager_rows(self.name) if self.paged_mode else self.user_permission_manager_mapper
+        if _is_background_workload([(users, rows)]):
+            enqueue_permission_jobs(self.name, users)
+            return
+
+        release_manager_permissions(self.name, users)
+
+    def sync_user_permissions(self, old_doc=None):
+        """Apply the changes since `old_doc`, in a background job when the workload is large."""
+        if self.flags.skip_permission_apply:
+            # The caller applies the rows itself, as the importer does
+            return
+
+        if self.paged_mode:
+            delta = self.plan_paged_delta(old_doc)
+        else:
+            delta = plan_permission_delta(
+                [u.user for u in old_doc.users] if old_doc else [],
+                old_doc.user_permission_manager_mapper if old_doc else [],
+                self.get_user_list(),
+                self.user_permission_manager_mapper,
+            )
+        self.apply_delta(delta)
+
+    def apply_delta(self, delta, operation="Update"):
+        """Clear and apply `delta` for this manager, in a background job when the workload is large."""
+        if _is_background_workload(delta["clear"] + delta["apply"]):
+            self.db_set("status", "Queued", update_modified=False)
+            enqueue_permission_jobs(
+                self.name, [user for users, rows in delta["clear"] + delta["apply"] for user in users], delta
+            )
+            frappe.msgprint(
+                _("User Permissions will be applied in the background."), alert=True, indicator="blue"
+            )
+            return
+
+        result = apply_permission_delta(delta, self.name, operation=operation)
+        _report_result(result)
+
+        if (self.status and self.status != "Done") or self.apply_checkpoint:
+            self.db_set({"status": "Done", "apply_checkpoint": None}, update_modified=False)
+
+    def store_paged_rows(self):
+        """Write the rows moved out of the form and the current users to the paged tables.
+
+        The users and rows stored before are kept in flags for `plan_paged_delta`.
+        """
+        self.flags.previous_users = get_stored_users(self.name)
+        self.flags.previous_rows = None
+        if self.flags.paged_rows:
+            self.flags.previous_rows = get_manager_rows(self.name)
+            insert_paged_rows(self.name, PAGED_MAPPER_FIELD, self.flags.paged_rows)
+            self.flags.paged_rows = None
+
+        # Only users that joined or left are written; role members come back in no set order
+        users = self.get_user_list()
+        previous_users = set(self.flags.previous_users)
+        for chunk in _chunk(previous_users.difference(users)):
+            frappe.db.delete("User Permissions Manager Child User", {
+                "parent": self.name,
+                "parenttype": "User Permissions Manager",
+                "parentfield": ["in", USER_PARENTFIELDS],
+                "user": ["in", chunk],
+            })
+        insert_paged_rows(
+            self.name, PAGED_USERS_FIELD, [{"user": user} for user in users if user not in previous_users]
+        )
+
+    def plan_paged_delta(self, old_doc):
+        """Plan the save of a paged manager against what was stored before it.
+
+        Rows edited through the paged endpoints have been applied already, so
+        only rows added through the form and changed users are planned here.
+        """
+        rows = get_manager_rows(self.name)
+        if old_doc and not old_doc.paged_mode:
+            # The rows were moved out of the form by this save
+            return plan_permission_delta(
+                [u.user for u in old_doc.users], old_doc.user_permission_manager_mapper, self.get_user_list(), rows
+            )
+
+        previous_rows = rows if self.flags.previous_rows is None else self.flags.previous_rows
+        return plan_permission_delta(self.flags.previous_users or [], previous_rows, self.get_user_list(), rows)
+
+    def get_rows_to_validate(self):
+        """Return the form's rows, with the stored rows of the same doctypes for paged managers."""
+        rows = list(self.user_permission_manager_mapper)
+        if self.paged_mode and rows and not self.is_new():
+            # Stored rows edited in the form are checked in their edited state only
+            names = {row.name for row in rows}
+            stored = get_stored_rows(self.name, list({row.allow for row in rows}))
+            rows = [row for row in stored if row.name not in names] + rows
+        return rows
+
+    def validate_filter_rules(self):
+        for row in self.user_permission_manager_mapper:
+            if row.rule_type != "Filter":
+                row.value_filters = None
+                if not row.for_value:
+                    frappe.throw(
+                        _("Row #{0}: For Value is required for {1}.").format(row.idx, row.allow),
+                        frappe.MandatoryError,
+                    )
+                continue
+
+            row.for_value = None
+            if row.is_default:
+                frappe.throw(
+                    _("Row #{0}: A Filter rule cannot be a default.").format(row.idx),
+                    title="Invalid Filter Rule",
+                )
+            try:
+                frappe.get_all(row.allow, filters=json.loads(row.value_filters or "{}"), limit=1)
+            except Exception:
+                frappe.throw(
+                    _("Row #{0}: Invalid filters for {1}.").format(row.idx, row.allow),
+                    title="Invalid Filter Rule",
+                )
 
     def validate_user_permission(self):
+        """Reject duplicate rows and rows mixing global and scoped access to the same value.
+
+        Every row applies to every user, so the checks only depend on the rows.
+        Filter rules are only checked for duplicates.
+        """
+        if not self.get_user_list():
+            return
+
         seen = set()
-        scoped_permissions = defaultdict(set)
         global_permissions = set()
-
-        for row in self.user_permission_manager_mapper:
-            for user in self.get_user_list():
-                key = (
-                    user,
-                    row.allow,
-                    row.for_value,
-                    row.applicable_for or "",
-                    row.apply_to_all_doctypes,
+        scoped_permissions = set()
+        for row in self.get_rows_to_validate():
+            key = (
+                row.allow,
+                row.for_value or row.value_filters,
+                row.applicable_for or "",
+                row.apply_to_all_doctypes,
+            )
+            if key in seen:
+                frappe.throw(
+                    _("Row #{0}: Duplicate row for '{1}' and value '{2}'.").format(
+                        row.idx, row.allow, row.for_value or row.value_filters
+                    ),
+                    title="Duplicate User Permissions",
                 )
-                if key in seen:
+            seen.add(key)
+            if row.rule_type == "Filter":
+                continue
+
+            conflict_key = (row.allow, row.for_value)
+            if row.apply_to_all_doctypes:
+                if conflict_key in scoped_permissions:
+                    frappe.throw(
+                        _("Conflicting global and scoped permissions for '{0}' and value '{1}'.").format(
+                            row.allow, row.for_value
+                        ),
+                        title="Conflicting Permissions",
+                    )
+                global_permissions.add(conflict_key)
+            else:
+                if conflict_key in global_permissions:
                     frappe.throw(
-                        _("Duplicate rows found for user '{0}' in User Permissions Manager.").format(user),
-                        title="Duplicate User Permissions",
+                        _("Conflicting scoped and global permissions for '{0}' and value '{1}'.").format(
+                            row.allow, row.for_value
+                        ),
+                        title="Conflicting Permissions",
                     )
-                seen.add(key)
-
-                conflict_key = (row.allow, row.for_value)
-                if row.apply_to_all_doctypes:
-                    if conflict_key in scoped_permissions:
-                        frappe.throw(
-                            _("Conflicting global and scoped permissions for '{0}' and value '{1}'.").format(
-                                row.allow, row.for_value
-                            ),
-                            title="Conflicting Permissions",
-                        )
-                    global_permissions.add(conflict_key)
-                else:
-                    if conflict_key in global_permissions:
-                        frappe.throw(
-                            _("Conflicting scoped and global permissions for '{0}' and value '{1}'.").format(
-                                row.allow, row.for_value
-                            ),
-                            title="Conflicting Permissions",
-                        )
-                    scoped_permissions[conflict_key].add(row.applicable_for)
+                scoped_permissions.add(conflict_key)
 
     def validate_default_permission(self):
-        seen = {}
-        for row in self.user_permission_manager_mapper:
+        if not self.get_user_list():
+            return
+
+        seen = set()
+        for row in self.get_rows_to_validate():
             if row.is_default:
-                for user in self.get_user_list():
-                    key = (user, row.allow)
-                    if key in seen:
-                        frappe.throw(
-                            _("Multiple defaults found for user '{0}' and Doctype '{1}'. Only one is allowed.")
-                            .format(user, row.allow),
-                            title="Multiple Default Permissions",
-                        )
-                    seen[key] = 1
-
-    def _trigger_permission_refresh(self):
-        for u in self.get_user_list():
-            frappe.cache.hdel("user_permissions", u)
-            frappe.publish_realtime("update_user_permissions", user=u, after_commit=True)
+                if row.allow in seen:
+                    frappe.throw(
+                        _("Row #{0}: Multiple defaults found for Doctype '{1}'. Only one is allowed.")
+                        .format(row.idx, row.allow),
+                        title="Multiple Default Permissions",
+                    )
+                seen.add(row.allow)
+
+    def validate_cross_manager_conflicts(self):
+        """Check the rows against User Permissions other managers have created for the same users.
+
+        A default that clashes with another manager's default is rejected, as
+        User Permission validation would reject it on apply. Global rows that
+        would replace another manager's scoped rows, or the other way round,
+        are reported as a warning.
+        """
+        mapper = expand_rows(self.user_permission_manager_mapper)
+        rows = {}
+        for row in mapper:
+            rows.setdefault(row.allow, []).append(row)
+
+        users = self.get_user_list()
+        if not rows or not users:
+            return
+
+        overlaps = set()
+        values = list({row.for_value for row in mapper})
+        for other in find_other_manager_permissions(self.name, users, list(rows), values):
+            for row in rows[other.allow]:
+                same_scope = (
+                    row.apply_to_all_doctypes
+                    or other.apply_to_all_doctypes
+                    or row.applicable_for == other.applicable_for
+                )
+                if row.is_default and other.is_default and row.for_value != other.for_value and same_scope:
+                    frappe.throw(
+                        _("User '{0}' already has '{1}' as default for '{2}' from User Permissions Manager {3}.")
+                        .format(other.user, other.for_value, other.allow, other.manager),
+                        title="Conflicting Default Permissions",
+                    )
+                if row.for_value == other.for_value and cint(row.apply_to_all_doctypes) != other.apply_to_all_doctypes:
+                    overlaps.add((other.allow, other.for_value, other.manager))
+
+        for allow, for_value, manager in sorted(overlaps):
+            frappe.msgprint(
+                _("Permissions on '{0}' for value '{1}' given by User Permissions Manager {2} will be replaced.")
+                .format(allow, for_value, manager),
+                indicator="orange",
+                alert=True,
+            )
 
     def get_user_list(self):
+        """Return the de-duplicated users this manager applies to.
+
+        Role membership is resolved once and reused by every hook of the
+        current document lifecycle; call `invalidate_user_list` after changing
+        `roles`, `apply_to_role` or `users`.
+        """
+        if getattr(self, "_user_list", None) is None:
+            self._user_list = self._resolve_user_list()
+        return self._user_list
+
+    def invalidate_user_list(self):
+        self._user_list = None
+
+    def _resolve_user_list(self):
         if self.apply_to_role:
             roles = [r.role for r in self.roles or []]
             if not roles:
                 frappe.throw(_("No roles selected to apply user permissions."))
+            return get_role_users(roles)
+
+        users = [u.user for u in self.users or []]
+        if self.paged_mode and not self.is_new():
+            users = get_stored_users(self.name) + users
+        return list(dict.fromkeys(users))
+
+
+@frappe.whitelist()
+def apply_bulk_user_permissions(docname, batch_size=None):
+    """Apply a saved manager, reading only its user list and mapper columns instead of the document."""
+    frappe.has_permission("User Permissions Manager", "write", throw=True)
+    return apply_user_permissions(docname, batch_size=cint(batch_size))
+
+
+def apply_user_permissions(doc, batch_size=None):
+    """Apply every row of `doc` to all of its users, skipping permissions that already exist.
+
+    `doc` is either an in-memory document, whose rows are used as they are,
+    or the name of a saved manager, which is read through the projected
+    loaders.
+    """
+    if isinstance(doc, str):
+        docname, users, rows = doc, get_manager_users(doc), get_manager_rows(doc)
+    else:
+        docname, users, rows = doc.name, doc.get_user_list(), doc.user_permission_manager_mapper
+
+    delta = plan_permission_delta([], [], users, rows)
+    result = apply_permission_delta(delta, docname, batch_size=batch_size, operation="Apply")
+    _report_result(result)
+    return {"success": result["success"], "errors": result["errors"], "metrics": result["metrics"]}
+
+
+def get_manager_users(docname):
+    """Return the users of a saved manager without loading it; role members are resolved afresh."""
+    apply_to_role = frappe.db.get_value("User Permissions Manager", docname, "apply_to_role")
+    if apply_to_role is None:
+        raise frappe.DoesNotExistError(_("User Permissions Manager {0} not found").format(docname))
+
+    if apply_to_role:
+        return get_role_users(frappe.get_all(
+            "User Permissions Manager Child Role",
+            filters={"parent": docname, "parenttype": "User Permissions Manager", "parentfield": "roles"},
+            pluck="role",
+        ))
+
+    return get_stored_users(docname)
+
+
+def get_role_users(roles):
+    users = frappe.get_all(
+        "Has Role",
+        filters={
+            "role": ["in", roles],
+            "parenttype": "User"  # Only get User documents, not Reports
+        },
+        pluck="parent"
+    )
+    return list(dict.fromkeys(users))
 
-            users = frappe.get_all(
-                "Has Role",
+
+@frappe.whitelist()
+def apply_bulk_user_permissions_batch(docnames, batch_size=None):
+    frappe.has_permission("User Permissions Manager", "write", throw=True)
+    if isinstance(docnames, str):
+        docnames = json.loads(docnames)
+    return apply_managers(list(dict.fromkeys(docnames)), batch_size=cint(batch_size))
+
+
+def apply_managers(docnames, batch_size=None):
+    """Apply several managers against one shared snapshot of existing User Permissions.
+
+    Users are handled `LOCK_CHUNK_SIZE` at a time, each chunk locked, read,
+    planned and written on its own. Entries given by more than one manager
+    are written once and recorded in the ledger for each of them. A single
+    cache refresh for the touched users follows.
+    """
+    metrics = OperationMetrics(None, "Batch Apply")
+    managers = load_manager_rows(docnames)
+    users = list(dict.fromkeys(user for manager_users, rows in managers.values() for user in manager_users))
+    doctypes = {row.allow for manager_users, rows in managers.values() for row in rows}
+    result = {"success": 0, "errors": []}
+    touched_users = set()
+
+    for chunk in _chunk(users, LOCK_CHUNK_SIZE):
+        parts = {manager: restrict_parts([part], set(chunk)) for manager, part in managers.items()}
+        with permission_locks([part for manager_parts in parts.values() for part in manager_parts]):
+            with metrics.stage("lookup"):
+                snapshot = load_permission_snapshot(chunk, doctypes)
+
+            with metrics.stage("planning"):
+                entries, relied, skipped = plan_manager_permissions(parts, snapshot)
+
+            with metrics.stage("insert"):
+                written = write_user_permissions(entries, batch_size=batch_size)
+                for manager, manager_entries in relied.items():
+                    _claim_permissions(manager, manager_entries)
+        metrics.add(inserted=written["inserted"], skipped=skipped, deleted=written["removed"])
+        result["success"] += written["success"]
+        result["errors"] += written["errors"]
+        touched_users.update(data["user"] for data in entries)
+
+    with metrics.stage("cache_refresh"):
+        refresh_user_permission_cache(touched_users)
+    metrics.add(users_invalidated=len(touched_users))
+
+    metrics.save()
+    result["metrics"] = metrics.as_dict()
+    _report_result(result)
+    return result
+
+
+def plan_manager_permissions(parts, snapshot):
+    """Plan {manager: [(users, rows), ...]} against one shared snapshot.
+
+    Rows of all managers are grouped per (user, allow, for_value) before
+    planning, so each entry is planned once, as `add_user_permissions` would
+    apply the combined rows, and lists the managers giving it in `managers`.
+    Returns the entries to write; the entries each manager relies on, for
+    `_claim_permissions`; and the number of entries that were already applied.
+    """
+    grouped = None
+    for manager, manager_parts in parts.items():
+        for users, rows in manager_parts:
+            grouped = _group_permission_entries(rows, users, grouped, manager=manager)
+
+    plan = _plan_grouped_entries(grouped or {}, snapshot)
+    relied = defaultdict(list)
+    for data in plan["insert"] + plan["skip"]:
+        for manager in data["managers"]:
+            relied[manager].append(data)
+
+    return plan["insert"], relied, len(plan["skip"])
+
+
+@frappe.whitelist()
+def preview_user_permissions(doc):
+    """Return what saving `doc` would insert, skip, delete and flag as conflicts, without writing.
+
+    `doc` is the unsaved form state. Its users and rows are compared with the
+    saved document the same way `on_update` does, and the plan is built from
+    the same chunked snapshot and ledger reads the apply path uses.
+    """
+    frappe.has_permission("User Permissions Manager", "write", throw=True)
+    if isinstance(doc, str):
+        doc = json.loads(doc)
+    doc = frappe.get_doc(doc)
+
+    old_users, old_rows = [], []
+    if not doc.get("__islocal") and frappe.db.exists("User Permissions Manager", doc.name):
+        old_users = get_stored_users(doc.name)
+        old_rows = get_manager_rows(doc.name)
+
+    new_rows = doc.user_permission_manager_mapper
+    if doc.paged_mode:
+        # The stored rows stay; rows in the form are added to them
+        new_rows = old_rows + list(new_rows)
+    delta = plan_permission_delta(old_users, old_rows, doc.get_user_list(), new_rows)
+
+    ledger = []
+    for users, rows in delta["clear"]:
+        ledger += _find_manager_ledger(doc.name, users, rows)
+    deleted = _unreferenced_permissions(ledger)
+
+    existing, defaults = load_permission_snapshot(
+        {user for users, rows in delta["apply"] for user in users},
+        {row.allow for users, rows in delta["apply"] for row in rows},
+    )
+    for state in existing.values():
+        if state["global"] in deleted:
+            state["global"] = None
+        state["scoped"] = {a: name for a, name in state["scoped"].items() if name not in deleted}
+    for current in defaults.values():
+        for name in deleted.intersection(current):
+            del current[name]
+
+    inserts, skips = [], []
+    for users, rows in delta["apply"]:
+        plan = plan_user_permissions(rows, users, snapshot=(existing, defaults))
+        inserts += plan["insert"]
+        skips += plan["skip"]
+    conflicts = [data for data in inserts if data["fallback"]]
+
+    return {
+        "background": _is_background_workload(delta["clear"] + delta["apply"]),
+        "insert": _preview_part(inserts),
+        "skip": _preview_part(skips),
+        "delete": {"count": len(deleted), "sample": frappe.get_all(
+            "User Permission",
+            filters={"name": ["in", list(deleted)[:PREVIEW_SAMPLE_SIZE]]},
+            fields=["user", "allow", "for_value", "applicable_for"],
+        ) if deleted else []},
+        "conflict": _preview_part(conflicts),
+    }
+
+
+def _preview_part(entries):
+    return {
+        "count": len(entries),
+        "sample": [
+            {
+                "user": data["user"],
+                "allow": data["doctype"],
+                "for_value": data["docname"],
+                "applicable_for": ", ".join(data["applicable_doctypes"]),
+            }
+            for data in entries[:PREVIEW_SAMPLE_SIZE]
+        ],
+    }
+
+
+def get_role_manager_index():
+    """Return {role: [manager names]} for managers that apply to roles."""
+    return frappe.cache.get_value(ROLE_INDEX_CACHE_KEY, generator=_build_role_manager_index)
+
+
+def _build_role_manager_index():
+    managers = frappe.get_all("User Permissions Manager", filters={"apply_to_role": 1}, pluck="name")
+    index = defaultdict(list)
+    for chunk in _chunk(managers):
+        for row in frappe.get_all(
+            "User Permissions Manager Child Role",
+            filters={"parenttype": "User Permissions Manager", "parent": ["in", chunk]},
+            fields=["parent", "role"],
+        ):
+            if row.parent not in index[row.role]:
+                index[row.role].append(row.parent)
+    return dict(index)
+
+
+def find_other_manager_permissions(manager, users, doctypes, values):
+    """Return the User Permissions of `users` on `doctypes` recorded by managers other than `manager`.
+
+    Only defaults and rows for one of `values` are returned; permissions
+    shared with `manager` are left out. One joined query runs per chunk of
+    users.
+    """
+    permission = frappe.qb.DocType("User Permission")
+    provenance = frappe.qb.DocType("User Permission Provenance")
+    own = frappe.qb.from_(provenance).select(provenance.user_permission).where(provenance.manager == manager)
+
+    result = []
+    for chunk in _chunk(users):
+        result += (
+            frappe.qb.from_(permission)
+            .join(provenance)
+            .on(provenance.user_permission == permission.name)
+            .select(
+                permission.user,
+                permission.allow,
+                permission.for_value,
+                permission.is_default,
+                permission.apply_to_all_doctypes,
+                permission.applicable_for,
+                provenance.manager,
+            )
+            .distinct()
+            .where(
+                permission.user.isin(chunk)
+                & permission.allow.isin(doctypes)
+                & (provenance.manager != (manager or ""))
+                & ((permission.is_default == 1) | permission.for_value.isin(values))
+                & permission.name.notin(own)
+            )
+            .run(as_dict=True)
+        )
+    return result
+
+
+def get_manager_rows(docname):
+    """Load only the mapper columns the apply and clear paths need, with filter rules expanded."""
+    return expand_rows(frappe.get_all(
+        "User Permissions Manager Child",
+        filters={
+            "parent": docname,
+            "parenttype": "User Permissions Manager",
+            "parentfield": ["in", MAPPER_PARENTFIELDS],
+        },
+        fields=MAPPER_FIELDS,
+        order_by="idx",
+    ))
+
+
+def get_stored_rows(docname, allows=None):
+    """Return the stored mapper rows of a manager as they are, optionally only those for `allows`."""
+    filters = {
+        "parent": docname,
+        "parenttype": "User Permissions Manager",
+        "parentfield": ["in", MAPPER_PARENTFIELDS],
+    }
+    if allows is not None:
+        filters["allow"] = ["in", allows]
+    return frappe.get_all(
+        "User Permissions Manager Child", filters=filters, fields=["name", "idx", *MAPPER_FIELDS], order_by="idx"
+    )
+
+
+def get_stored_users(docname):
+    """Return the stored users of a manager; for role managers, the users last applied."""
+    return list(dict.fromkeys(frappe.get_all(
+        "User Permissions Manager Child User",
+        filters={
+            "parent": docname,
+            "parenttype": "User Permissions Manager",
+            "parentfield": ["in", USER_PARENTFIELDS],
+        },
+        pluck="user",
+        order_by="idx",
+    )))
+
+
+def insert_paged_rows(docname, parentfield, rows):
+    """Append `rows` to one of the paged tables of a manager with multi-row inserts; returns the rows.
+
+    Rows are built as child documents in memory only, for their column
+    defaults and types, and written with one `bulk_insert`.
+    """
+    if parentfield == PAGED_MAPPER_FIELD:
+        doctype, fields = "User Permissions Manager Child", MAPPER_FIELDS
+    else:
+        doctype, fields = "User Permissions Manager Child User", ["user"]
+
+    filters = {"parent": docname, "parenttype": "User Permissions Manager", "parentfield": parentfield}
+    idx = cint(next(iter(frappe.get_all(doctype, filters=filters, pluck="idx", order_by="idx desc", limit=1)), 0))
+    now = frappe.utils.now()
+    owner = frappe.session.user
+    inserted = []
+    for row in rows:
+        idx += 1
+        inserted.append(frappe.get_doc({
+            **{field: row.get(field) for field in fields},
+            **filters,
+            "doctype": doctype,
+            "name": frappe.generate_hash(length=10),
+            "idx": idx,
+            "creation": now,
+            "modified": now,
+            "owner": owner,
+            "modified_by": owner,
+        }))
+
+    if inserted:
+        values = [child.get_valid_dict(convert_dates_to_str=True) for child in inserted]
+        columns = list(values[0])
+        frappe.db.bulk_insert(
+            doctype,
+            fields=columns,
+            values=[tuple(value[column] for column in columns) for value in values],
+            chunk_size=BULK_INSERT_BATCH_SIZE,
+        )
+    return inserted
+
+
+def expand_rows(rows):
+    """Replace every filter rule in `rows` by one row per matching `allow` record.
+
+    Each rule is expanded with a single query; other rows are returned as is.
+    """
+    expanded = []
+    for row in rows:
+        if row.get("rule_type") != "Filter":
+            expanded.append(row)
+            continue
+
+        for value in frappe.get_all(row.allow, filters=json.loads(row.value_filters or "{}"), pluck="name"):
+            expanded.append(frappe._dict(_row_values(row), for_value=value))
+    return expanded
+
+
+def get_managed_doctypes():
+    """Return the set of `allow` doctypes across all managers' rows."""
+    return frappe.cache.get_value(MANAGED_DOCTYPES_CACHE_KEY, generator=_build_managed_doctypes)
+
+
+def _build_managed_doctypes():
+    return set(frappe.get_all(
+        "User Permissions Manager Child",
+        filters={"parenttype": "User Permissions Manager", "parentfield": ["in", MAPPER_PARENTFIELDS]},
+        pluck="allow",
+        distinct=True,
+    ))
+
+
+def get_filter_rule_index():
+    """Return {allow: [filter rule rows]} across all managers."""
+    return frappe.cache.get_value(FILTER_RULE_INDEX_CACHE_KEY, generator=_build_filter_rule_index)
+
+
+def _build_filter_rule_index():
+    index = defaultdict(list)
+    for row in frappe.get_all(
+        "User Permissions Manager Child",
+        filters={
+            "parenttype": "User Permissions Manager",
+            "parentfield": ["in", MAPPER_PARENTFIELDS],
+            "rule_type": "Filter",
+        },
+        fields=["parent", *MAPPER_FIELDS],
+    ):
+        index[row.allow].append(row)
+    return dict(index)
+
+
+def load_manager_rows(docnames, with_users=True):
+    """Return {manager: (users, rows)} for `docnames`, read with chunked child table queries.
+
+    Users of role managers are resolved afresh, as `get_manager_users` does.
+    Without `with_users` the user lists are left empty.
+    """
+    managers = {name: ([], []) for name in docnames}
+    for chunk in _chunk(docnames):
+        if with_users:
+            role_managers = set(frappe.get_all(
+                "User Permissions Manager", filters={"name": ["in", chunk], "apply_to_role": 1}, pluck="name"
+            ))
+            for manager in role_managers:
+                managers[manager][0].extend(get_manager_users(manager))
+
+            for row in frappe.get_all(
+                "User Permissions Manager Child User",
                 filters={
-                    "role": ["in", roles],
-                    "parenttype": "User"  # Only get User documents, not Reports
+                    "parent": ["in", [name for name in chunk if name not in role_managers]],
+                    "parenttype": "User Permissions Manager",
+                    "parentfield": ["in", USER_PARENTFIELDS],
                 },
-                fields=["parent as user"]
+                fields=["parent", "user"],
+                order_by="idx",
+            ):
+                managers[row.parent][0].append(row.user)
+
+        for row in frappe.get_all(
+            "User Permissions Manager Child",
+            filters={
+                "parent": ["in", chunk],
+                "parenttype": "User Permissions Manager",
+                "parentfield": ["in", MAPPER_PARENTFIELDS],
+            },
+            fields=["parent", *MAPPER_FIELDS],
+            order_by="idx",
+        ):
+            managers[row.parent][1].append(row)
+
+    for _users, rows in managers.values():
+        rows[:] = [_row_values(row) for row in expand_rows(rows)]
+    return managers
+
+
+def plan_permission_delta(old_users, old_rows, new_users, new_rows):
+    """Compare two (users x rows) sets and return the parts that changed.
+
+    Filter rules are expanded into value rows on both sides first. Returns
+    `{"clear": [(users, rows), ...], "apply": [(users, rows), ...]}`.
+    Rows that were removed or edited are cleared for the previous users, and
+    kept rows only for users that were removed. Added users get every row,
+    remaining users only the rows sharing an (allow, for_value) with an added
+    or edited row, so that scoped permissions are regrouped correctly.
+    """
+    old_rows = {_row_signature(row): _row_values(row) for row in expand_rows(old_rows)}
+    new_rows = {_row_signature(row): _row_values(row) for row in expand_rows(new_rows)}
+    old_users = list(dict.fromkeys(old_users))
+    new_users = list(dict.fromkeys(new_users))
+    old_user_set = set(old_users)
+    new_user_set = set(new_users)
+
+    removed_users = [user for user in old_users if user not in new_user_set]
+    added_users = [user for user in new_users if user not in old_user_set]
+    kept_users = [user for user in new_users if user in old_user_set]
+
+    removed_rows = [row for signature, row in old_rows.items() if signature not in new_rows]
+    kept_rows = [row for signature, row in old_rows.items() if signature in new_rows]
+    added_keys = {(row.allow, row.for_value) for signature, row in new_rows.items() if signature not in old_rows}
+    regrouped_rows = [row for row in new_rows.values() if (row.allow, row.for_value) in added_keys]
+
+    delta = {"clear": [], "apply": []}
+    for users, rows, part in (
+        (old_users, removed_rows, "clear"),
+        (removed_users, kept_rows, "clear"),
+        (added_users, list(new_rows.values()), "apply"),
+        (kept_users, regrouped_rows, "apply"),
+    ):
+        if users and rows:
+            delta[part].append((users, rows))
+
+    return delta
+
+
+def restrict_parts(parts, users):
+    """Return (users, rows) `parts` limited to the set `users`, leaving out parts without any of them."""
+    restricted = []
+    for part_users, rows in parts:
+        part_users = [user for user in part_users if user in users]
+        if part_users:
+            restricted.append((part_users, rows))
+    return restricted
+
+
+def apply_permission_delta(
+    delta,
+    manager,
+    batch_size=None,
+    progress=None,
+    operation="Update",
+    metrics=None,
+    refresh_cache=True,
+    ignore_permissions=False,
+):
+    """Clear and apply the parts returned by `plan_permission_delta` on behalf of `manager`.
+
+    Users are handled `LOCK_CHUNK_SIZE` at a time: the chunk's locks are
+    taken, its rows cleared, read, planned and written, and the locks
+    released before the next chunk. `progress`, if given, is called with
+    (users done, total users) after every chunk.
+
+    Every stage is instrumented; the metrics are returned under `metrics` and
+    saved as a User Permissions Manager Log. Callers passing their own
+    `metrics` accumulate several calls into it and save it themselves.
+    Without `refresh_cache` the caller refreshes the cache of the touched
+    users, which are returned under `users`. `ignore_permissions` is passed
+    on to `write_user_permissions`.
+    """
+    save_metrics = metrics is None
+    metrics = metrics or OperationMetrics(manager, operation)
+    parts = delta["clear"] + delta["apply"]
+    users = list(dict.fromkeys(user for part_users, rows in parts for user in part_users))
+    result = {"success": 0, "errors": []}
+    touched_users = set()
+    done = 0
+
+    for chunk in _chunk(users, LOCK_CHUNK_SIZE):
+        members = set(chunk)
+        clear, apply = restrict_parts(delta["clear"], members), restrict_parts(delta["apply"], members)
+        with permission_locks(clear + apply):
+            with metrics.stage("delete"):
+                for part_users, rows in clear:
+                    metrics.add(deleted=clear_permission_entries(manager, part_users, rows))
+                    touched_users.update(part_users)
+
+            with metrics.stage("lookup"):
+                snapshot = load_permission_snapshot(
+                    {user for part_users, rows in apply for user in part_users},
+                    {row.allow for part_users, rows in apply for row in rows},
+                )
+
+            entries = []
+            skipped = []
+            with metrics.stage("planning"):
+                for part_users, rows in apply:
+                    plan = plan_user_permissions(rows, part_users, snapshot=snapshot)
+                    entries += plan["insert"]
+                    skipped += plan["skip"]
+
+            with metrics.stage("insert"):
+                written = write_user_permissions(
+                    entries, manager=manager, batch_size=batch_size, ignore_permissions=ignore_permissions
+                )
+                _claim_permissions(manager, entries + skipped)
+        metrics.add(inserted=written["inserted"], skipped=len(skipped), deleted=written["removed"])
+        result["success"] += written["success"]
+        result["errors"] += written["errors"]
+        touched_users.update(data["user"] for data in entries)
+        done += len(chunk)
+        if progress:
+            progress(done, len(users))
+
+    if refresh_cache:
+        with metrics.stage("cache_refresh"):
+            refresh_user_permission_cache(touched_users)
+        metrics.add(users_invalidated=len(touched_users))
+
+    if save_metrics:
+        metrics.save()
+    return {**result, "metrics": metrics.as_dict(), "users": touched_users}
+
+
+def release_manager_permissions(docname, users):
+    """Release everything the manager owns and refresh the cache of its users, with metrics."""
+    metrics = OperationMetrics(docname, "Trash")
+    with metrics.stage("delete"):
+        metrics.add(deleted=delete_user_permissions(docname))
+    with metrics.stage("cache_refresh"):
+        refresh_user_permission_cache(users)
+    metrics.add(users_invalidated=len(users))
+    metrics.save()
+
+
+def enqueue_permission_jobs(docname, users, delta=None, ignore_permissions=False):
+    """Queue the background sync of `delta`, or without it the cleanup of a trashed manager.
+
+    Work is split over up to `FANOUT_PARTITIONS` jobs on the long queue,
+    one per `PARTITION_MIN_USERS` users at most. A sync is split with
+    `partition_delta`, so the jobs never wait on each other's locks; a
+    cleanup takes no locks and is split into slices of sorted users. A
+    single partition runs as one checkpointed `run_permission_sync` or
+    `run_permission_cleanup` job.
+    """
+    users = sorted(set(users))
+    partitions = cint(frappe.conf.get("user_permissions_manager_partitions")) or FANOUT_PARTITIONS
+    partitions = max(1, min(partitions, len(users) // PARTITION_MIN_USERS))
+    job = "frappe_permission_manager.frappe_permission_manager.doctype.user_permissions_manager.user_permissions_manager."
+
+    if partitions == 1:
+        frappe.enqueue(
+            job + ("run_permission_cleanup" if delta is None else "run_permission_sync"),
+            queue="long",
+            timeout=BACKGROUND_JOB_TIMEOUT,
+            enqueue_after_commit=True,
+            docname=docname,
+            **({"users": users} if delta is None else {"delta": delta, "ignore_permissions": ignore_permissions}),
+        )
+        return
+
+    if delta is None:
+        slices = [(chunk, None) for chunk in _chunk(users, -(-len(users) // partitions))]
+    else:
+        # Partitions keep no checkpoint; a stale one would make a resume skip users this run never applied
+        frappe.db.set_value(
+            "User Permissions Manager", docname, "apply_checkpoint", None, update_modified=False
+        )
+        slices = [(_delta_users(part), part) for part in partition_delta(delta, partitions)]
+
+    run_id = frappe.generate_hash(length=10)
+    for slice_users, slice_delta in slices:
+        frappe.enqueue(
+            job + "run_permission_partition",
+            queue="long",
+            timeout=BACKGROUND_JOB_TIMEOUT,
+            enqueue_after_commit=True,
+            docname=docname,
+            run_id=run_id,
+            partitions=len(slices),
+            users=slice_users,
+            ignore_permissions=ignore_permissions,
+            delta=slice_delta,
+        )
+
+
+def partition_delta(delta, partitions):
+    """Split `delta` into up to `partitions` deltas that lock disjoint sets of stripes.
+
+    Rows are grouped by `allow`, and each user goes to the partition given
+    by the lock stripe of its (user, allow) pair modulo `partitions`. Rows
+    sharing an (allow, for_value) stay together, as planning needs.
+    """
+    split = [{"clear": [], "apply": []} for _ in range(partitions)]
+    for part in ("clear", "apply"):
+        for users, rows in delta[part]:
+            by_allow = defaultdict(list)
+            for row in rows:
+                by_allow[row.allow].append(row)
+
+            for allow, allow_rows in by_allow.items():
+                buckets = defaultdict(list)
+                for user in users:
+                    buckets[_lock_stripe(user, allow) % partitions].append(user)
+                for index, bucket in buckets.items():
+                    split[index][part].append((bucket, allow_rows))
+
+    return [part for part in split if part["clear"] or part["apply"]]
+
+
+def run_permission_partition(docname, run_id, partitions, users, delta=None, ignore_permissions=False):
+    """Background job syncing, or cleaning up, one partition of a manager.
+
+    Counts, errors and touched users are gathered in Redis under `run_id`;
+    the last job of the run to finish refreshes the cache of all touched
+    users once and sets the final status.
+    """
+    metrics = OperationMetrics(docname, "Trash" if delta is None else "Update")
+    result = {"success": 0, "errors": [], "users": set(users)}
+
+    try:
+        if delta is None:
+            with metrics.stage("delete"):
+                ledger = []
+                for chunk in _chunk(users):
+                    ledger += frappe.get_all(
+                        "User Permission Provenance",
+                        filters={"manager": docname, "user": ["in", chunk]},
+                        fields=["name", "user_permission"],
+                    )
+                metrics.add(deleted=_release_provenance(ledger))
+        else:
+            frappe.db.set_value("User Permissions Manager", docname, "status", "Running", update_modified=False)
+            result = apply_permission_delta(
+                delta, docname, metrics=metrics, refresh_cache=False, ignore_permissions=ignore_permissions
             )
-            return [u.user for u in users]
-        return [u.user for u in self.users or []]
+        metrics.save()
+        frappe.db.commit()
+    except Exception:
+        frappe.db.rollback()
+        _finish_partition(docname, run_id, partitions, result, delta is None, failed=True)
+        raise
+
+    _finish_partition(docname, run_id, partitions, result, delta is None)
+
+
+def _finish_partition(docname, run_id, partitions, result, cleanup, failed=False):
+    key = f"user_permissions_manager_fanout::{run_id}"
+    if result["users"]:
+        frappe.cache.sadd(f"{key}::users", *result["users"])
+    for error in result["errors"]:
+        frappe.cache.rpush(f"{key}::errors", error)
+    frappe.cache.incrby(frappe.cache.make_key(f"{key}::success"), result["success"])
+    frappe.cache.incrby(frappe.cache.make_key(f"{key}::failed"), int(failed))
+    finished = frappe.cache.incrby(frappe.cache.make_key(f"{key}::finished"), 1)
+    for name in ("users", "errors", "success", "failed", "finished"):
+        frappe.cache.expire(frappe.cache.make_key(f"{key}::{name}"), BACKGROUND_JOB_TIMEOUT * 2)
+
+    if finished < partitions:
+        if not cleanup:
+            _publish_progress(docname, "Running", finished, partitions)
+        return
+
+    users = [cstr(user) for user in frappe.cache.smembers(f"{key}::users")]
+    errors = [cstr(error) for error in frappe.cache.lrange(f"{key}::errors", 0, -1)]
+    failed = cint(frappe.cache.get(frappe.cache.make_key(f"{key}::failed")))
+    frappe.cache.delete_value([f"{key}::users", f"{key}::errors"])
+    frappe.cache.delete(*[frappe.cache.make_key(f"{key}::{name}") for name in ("success", "failed", "finished")])
+
+    if cleanup:
+        # Ledger rows of users that left the manager before it was trashed
+        delete_user_permissions(docname)
+    refresh_user_permission_cache(users)
+
+    if not cleanup:
+        status = "Failed" if failed else "Done"
+        frappe.db.set_value("User Permissions Manager", docname, "status", status, update_modified=False)
+        _publish_progress(docname, status, partitions, partitions, errors=errors)
+    frappe.db.commit()
+
+
+def run_permission_sync(docname, delta, resume=False, ignore_permissions=False):
+    """Background job counterpart of `UserPermissionsManager.sync_user_permissions`.
+
+    Cleared rows are committed first. Users are then applied in name order
+    and committed every `COMMIT_INTERVAL` entries or so, recording the last
+    committed user in `apply_checkpoint` for `resume_user_permissions`.
+    """
+    values = {"status": "Running"}
+    if not resume:
+        values["apply_checkpoint"] = None
+    frappe.db.set_value("User Permissions Manager", docname, values, update_modified=False)
+    frappe.db.commit()
+    _publish_progress(docname, "Running", 0, 0)
+
+    metrics = OperationMetrics(docname, "Resume" if resume else "Update")
+    result = {"success": 0, "errors": []}
+    users = sorted({user for part_users, rows in delta["apply"] for user in part_users})
+    rows_per_user = sum(len(rows) for part_users, rows in delta["apply"]) or 1
+    interval = cint(frappe.conf.get("user_permissions_manager_commit_interval")) or COMMIT_INTERVAL
+
+    try:
+        if delta["clear"]:
+            apply_permission_delta(
+                {"clear": delta["clear"], "apply": []}, docname, metrics=metrics, ignore_permissions=ignore_permissions
+            )
+            frappe.db.commit()
+
+        done = 0
+        for chunk in _chunk(users, max(1, interval // rows_per_user)):
+            part = {"clear": [], "apply": restrict_parts(delta["apply"], set(chunk))}
+            written = apply_permission_delta(part, docname, metrics=metrics, ignore_permissions=ignore_permissions)
+            result["success"] += written["success"]
+            result["errors"] += written["errors"]
+
+            frappe.db.set_value(
+                "User Permissions Manager", docname, "apply_checkpoint", chunk[-1], update_modified=False
+            )
+            frappe.db.commit()
+            done += len(chunk)
+            _publish_progress(docname, "Running", done, len(users))
+    except Exception:
+        frappe.db.rollback()
+        frappe.db.set_value("User Permissions Manager", docname, "status", "Failed", update_modified=False)
+        frappe.db.commit()
+        _publish_progress(docname, "Failed", 0, 0)
+        raise
+
+    metrics.save()
+    frappe.db.set_value(
+        "User Permissions Manager",
+        docname,
+        {"status": "Done", "apply_checkpoint": None},
+        update_modified=False,
+    )
+    _publish_progress(docname, "Done", len(users), len(users), errors=result["errors"])
 
 
 @frappe.whitelist()
-def apply_bulk_user_permissions(docname):
-    doc = frappe.get_doc("User Permissions Manager", docname)
-    users = doc.get_user_list()
+def resume_user_permissions(docname):
+    """Re-run a failed background apply for the users after its checkpoint.
+
+    Existing permissions are skipped, so users that were partly applied
+    before the failure are safe to process again. Rows cleared by a run
+    that failed before its first commit are left to the reconciliation job.
+    """
+    frappe.has_permission("User Permissions Manager", "write", throw=True)
+    status, checkpoint = frappe.db.get_value(
+        "User Permissions Manager", docname, ["status", "apply_checkpoint"]
+    )
+    if status != "Failed":
+        frappe.throw(_("Only a failed apply can be resumed."))
+
+    users = [user for user in get_manager_users(docname) if user > (checkpoint or "")]
+    frappe.db.set_value("User Permissions Manager", docname, "status", "Queued", update_modified=False)
+    frappe.enqueue(
+        "frappe_permission_manager.frappe_permission_manager.doctype.user_permissions_manager.user_permissions_manager.run_permission_sync",
+        queue="long",
+        timeout=BACKGROUND_JOB_TIMEOUT,
+        enqueue_after_commit=True,
+        docname=docname,
+        delta={"clear": [], "apply": [(users, get_manager_rows(docname))]},
+        resume=True,
+    )
+
+
+def run_permission_cleanup(docname, users):
+    """Background job that removes the permissions of a trashed manager."""
+    release_manager_permissions(docname, users)
+
+
+def refresh_user_permission_cache(users):
+    """Drop cached user permissions and notify open desks, a chunk of users at a time.
+
+    Each chunk is one multi-field HDEL and one broadcast carrying the user
+    list; the desk script reloads permissions only for the listed users.
+    """
+    for chunk in _chunk(users, REFRESH_CHUNK_SIZE):
+        frappe.cache.hdel("user_permissions", chunk)
+        frappe.publish_realtime("user_permissions_manager_refresh", {"users": chunk}, after_commit=True)
+
+
+def _report_result(result):
+    if result["success"]:
+        frappe.msgprint(_(f"Applied {result['success']} user permission(s) successfully."))
+
+    if result["errors"]:
+        frappe.msgprint(_("Some errors occurred:<br>") + "<br>".join(result["errors"]))
+
+
+def _is_background_workload(parts):
+    threshold = cint(frappe.conf.get("user_permissions_manager_background_threshold")) or BACKGROUND_JOB_THRESHOLD
+    return sum(len(users) * len(rows) for users, rows in parts) > threshold
+
+
+def _row_values(row):
+    return frappe._dict(
+        allow=row.allow,
+        for_value=row.for_value,
+        apply_to_all_doctypes=cint(row.apply_to_all_doctypes),
+        applicable_for=None if cint(row.apply_to_all_doctypes) else row.applicable_for,
+        is_default=cint(row.is_default),
+        hide_descendants=cint(row.hide_descendants),
+    )
+
+
+def _row_signature(row):
+    return tuple(_row_values(row).values())
+
+
+def _publish_progress(docname, status, done, total, errors=None):
+    frappe.publish_realtime(
+        "user_permissions_manager_progress",
+        {"status": status, "done": done, "total": total, "errors": errors or []},
+        doctype="User Permissions Manager",
+        docname=docname,
+        after_commit=status != "Running",
+    )
+
+
+def plan_user_permissions(rows, users, snapshot=None):
+    """Split the desired (user, allow, for_value) entries into inserts and skips.
+
+    Existing User Permissions for the affected users are loaded in a few chunked
+    queries and compared in memory, instead of one lookup per entry. Every insert
+    entry carries the existing rows it replaces (`remove`) and the rows it adds
+    (`insert_for`, `None` meaning apply to all doctypes), mirroring what
+    `add_user_permissions` would do for it. All entries list the existing rows
+    they keep as (name, applicable_for) in `existing`.
+
+    `snapshot` is a `load_permission_snapshot` result covering `users` and the
+    rows' doctypes, so that several plans can share one set of reads.
+    """
+    snapshot = snapshot or load_permission_snapshot(users, {row.allow for row in rows})
+    return _plan_grouped_entries(_group_permission_entries(rows, users), snapshot)
+
+
+def _plan_grouped_entries(grouped, snapshot):
+    existing, defaults = snapshot
+    plan = {"insert": [], "skip": []}
+    for key, data in grouped.items():
+        state = existing.get(key, {"global": None, "scoped": {}})
+        if data["apply_to_all_doctypes"]:
+            data["existing"] = [(state["global"], None)] if state["global"] else []
+        else:
+            data["existing"] = [
+                (state["scoped"][a], a) for a in data["applicable_doctypes"] if a in state["scoped"]
+            ]
+
+        if _is_already_applied(data, state):
+            plan["skip"].append(data)
+            continue
+
+        if data["apply_to_all_doctypes"]:
+            data["remove"] = list(state["scoped"].values())
+            data["insert_for"] = [None]
+        else:
+            applicable = data["applicable_doctypes"]
+            data["remove"] = [
+                name for applicable_for, name in state["scoped"].items() if applicable_for not in applicable
+            ]
+            if state["global"]:
+                data["remove"].append(state["global"])
+            data["insert_for"] = [a for a in applicable if a not in state["scoped"]]
+
+        data["fallback"] = _has_default_conflict(data, defaults)
+        plan["insert"].append(data)
+
+    return plan
+
+
+def write_user_permissions(entries, manager=None, batch_size=None, progress=None, ignore_permissions=False):
+    """Insert planned entries in multi-row batches.
 
+    Like `add_user_permissions`, this is limited to System Managers unless
+    `ignore_permissions` is set by hooks that only follow existing managers.
+
+    Entries that would trip User Permission validation, and whole batches whose
+    bulk insert fails, go through `add_user_permissions` one by one instead.
+    Inserted rows are recorded in the provenance ledger under `manager`, or
+    under each of the entry's `managers` when the entry lists them.
+    `progress`, if given, is called with (entries done, total entries) after
+    every batch. Returns the number of entries applied, the failed ones, and
+    the number of rows inserted and replaced.
+    """
+    if entries and not ignore_permissions:
+        frappe.only_for("System Manager")
+
+    batch_size = batch_size or frappe.conf.get("user_permissions_manager_batch_size") or BULK_INSERT_BATCH_SIZE
     success = 0
     errors = []
+    inserted = 0
+    removed = 0
 
-    grouped = defaultdict(lambda: {
-        "user": None,
-        "doctype": None,
-        "docname": None,
-        "apply_to_all_doctypes": 1,
-        "is_default": 0,
-        "hide_descendants": 0,
-        "applicable_doctypes": []
-    })
+    for batch in _chunk(entries, batch_size):
+        bulk = [data for data in batch if not data.get("fallback")]
+        fallback = [data for data in batch if data.get("fallback")]
+
+        if bulk:
+            frappe.db.savepoint("user_permissions_bulk_insert")
+            try:
+                _bulk_insert_entries(bulk, batch_size, manager)
+                success += len(bulk)
+                inserted += sum(len(data["insert_for"]) for data in bulk)
+                removed += sum(len(data["remove"]) for data in bulk)
+            except Exception:
+                frappe.db.rollback(save_point="user_permissions_bulk_insert")
+                fallback = batch
+
+        for data in fallback:
+            try:
+                add_user_permissions(data)
+                for entry_manager in data.get("managers") or filter(None, [manager]):
+                    _record_fallback_provenance(entry_manager, data)
+                success += 1
+                inserted += len(data["insert_for"])
+                removed += len(data["remove"])
+            except Exception:
+                errors.append(f"{data['user']}: {data['doctype']}/{data['docname']}")
+
+        if progress:
+            progress(success + len(errors), len(entries))
+
+    return {"success": success, "errors": errors, "inserted": inserted, "removed": removed}
+
+
+def _bulk_insert_entries(entries, batch_size, manager=None):
+    to_remove = [name for data in entries for name in data["remove"]]
+    for chunk in _chunk(to_remove):
+        frappe.db.delete("User Permission", {"name": ["in", chunk]})
+        frappe.db.delete("User Permission Provenance", {"user_permission": ["in", chunk]})
+
+    now = frappe.utils.now()
+    owner = frappe.session.user
+    values = []
+    provenance = defaultdict(list)
+    for data in entries:
+        for applicable_for in data["insert_for"]:
+            name = _permission_name(data["user"], data["doctype"], data["docname"], applicable_for)
+            for entry_manager in data.get("managers") or filter(None, [manager]):
+                provenance[entry_manager].append(
+                    (name, data["user"], _permission_key(data["doctype"], data["docname"], applicable_for))
+                )
+            values.append((
+                name,
+                now,
+                now,
+                owner,
+                owner,
+                data["user"],
+                data["doctype"],
+                data["docname"],
+                data["is_default"],
+                data["hide_descendants"],
+                0 if applicable_for else 1,
+                applicable_for,
+            ))
+
+    frappe.db.bulk_insert(
+        "User Permission",
+        fields=[
+            "name",
+            "creation",
+            "modified",
+            "owner",
+            "modified_by",
+            "user",
+            "allow",
+            "for_value",
+            "is_default",
+            "hide_descendants",
+            "apply_to_all_doctypes",
+            "applicable_for",
+        ],
+        values=values,
+        ignore_duplicates=True,
+        chunk_size=batch_size,
+    )
+
+    for entry_manager, records in provenance.items():
+        _record_provenance(entry_manager, records)
+
+
+def _group_permission_entries(rows, users, grouped=None, manager=None):
+    """Group (rows x users) into one entry per (user, allow, for_value), adding to `grouped` if given.
 
-    for row in doc.user_permission_manager_mapper:
+    An entry is scoped if any of its rows is, and a default, or hiding
+    descendants, if any of its rows is. With `manager`, entries list the
+    managers whose rows they combine under `managers`.
+    """
+    if grouped is None:
+        grouped = defaultdict(lambda: {
+            "user": None,
+            "doctype": None,
+            "docname": None,
+            "apply_to_all_doctypes": 1,
+            "is_default": 0,
+            "hide_descendants": 0,
+            "applicable_doctypes": []
+        })
+
+    for row in rows:
         for user in users:
             key = (user, row.allow, row.for_value)
 
@@ -178,76 +1435,303 @@ def apply_bulk_user_permissions(docname):
             entry["user"] = user
             entry["doctype"] = row.allow
             entry["docname"] = row.for_value
-            entry["is_default"] = row.is_default
-            entry["hide_descendants"] = row.hide_descendants
+            entry["is_default"] = max(cint(entry["is_default"]), cint(row.is_default))
+            entry["hide_descendants"] = max(cint(entry["hide_descendants"]), cint(row.hide_descendants))
+            if manager and manager not in entry.setdefault("managers", []):
+                entry["managers"].append(manager)
 
             if not row.apply_to_all_doctypes:
                 entry["apply_to_all_doctypes"] = 0
                 if row.applicable_for and row.applicable_for not in entry["applicable_doctypes"]:
                     entry["applicable_doctypes"].append(row.applicable_for)
 
-    for key, data in grouped.items():
-        existing = frappe.get_all(
+    return grouped
+
+
+def load_permission_snapshot(users, doctypes):
+    """Index existing User Permissions by (user, allow, for_value), and defaults by (user, allow)."""
+    existing = {}
+    defaults = defaultdict(dict)
+    if not users or not doctypes:
+        return existing, defaults
+
+    for chunk in _chunk(users):
+        permissions = frappe.get_all(
             "User Permission",
             filters={
-                "user": data["user"],
-                "allow": data["doctype"],
-                "for_value": data["docname"],
-                "apply_to_all_doctypes": data["apply_to_all_doctypes"],
+                "user": ["in", chunk],
+                "allow": ["in", list(doctypes)],
             },
-            fields=["name"]
+            fields=[
+                "name",
+                "user",
+                "allow",
+                "for_value",
+                "apply_to_all_doctypes",
+                "applicable_for",
+                "is_default",
+            ]
         )
+        for perm in permissions:
+            state = existing.setdefault(
+                (perm.user, perm.allow, perm.for_value), {"global": None, "scoped": {}}
+            )
+            if perm.apply_to_all_doctypes:
+                state["global"] = perm.name
+            elif perm.applicable_for:
+                state["scoped"][perm.applicable_for] = perm.name
+
+            if perm.is_default:
+                defaults[(perm.user, perm.allow)][perm.name] = (perm.apply_to_all_doctypes, perm.applicable_for)
+
+    return existing, defaults
+
+
+def _is_already_applied(data, state):
+    if data["apply_to_all_doctypes"]:
+        return bool(state["global"])
+    return set(data["applicable_doctypes"]).issubset(state["scoped"])
+
+
+def _has_default_conflict(data, defaults):
+    """Mirror UserPermission.validate_default_permission against the loaded snapshot.
+
+    Rows planned as defaults are recorded in `defaults` so that later entries
+    for the same (user, allow) see them too.
+    """
+    if not data["is_default"]:
+        return False
+
+    current = defaults[(data["user"], data["doctype"])]
+    for name in data["remove"]:
+        current.pop(name, None)
+
+    for applicable_for in data["insert_for"]:
+        for apply_to_all, existing_applicable_for in current.values():
+            if apply_to_all or cstr(existing_applicable_for) == cstr(applicable_for):
+                return True
+
+    for applicable_for in data["insert_for"]:
+        current[(data["user"], data["doctype"], data["docname"], applicable_for)] = (
+            0 if applicable_for else 1,
+            applicable_for,
+        )
+    return False
+
 
-        if data["apply_to_all_doctypes"] == 0:
-            existing = frappe.get_all(
-                "User Permission",
+def _chunk(items, size=QUERY_CHUNK_SIZE):
+    items = list(items)
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+def delete_user_permissions(docname):
+    """Release every User Permission the manager `docname` owns and return the number removed."""
+    ledger = frappe.get_all(
+        "User Permission Provenance", filters={"manager": docname}, fields=["name", "user_permission"]
+    )
+    return _release_provenance(ledger)
+
+
+def clear_permission_entries(manager, users, rows):
+    """Release the User Permissions that `rows` gave `users` through `manager`.
+
+    Ledger entries are looked up with chunked `user IN (...)` and
+    `permission_key IN (...)` filters. A User Permission is only deleted once
+    no other manager's ledger entry references it. Returns the number of
+    User Permissions removed.
+    """
+    return _release_provenance(_find_manager_ledger(manager, users, rows))
+
+
+def _find_manager_ledger(manager, users, rows):
+    keys = list({
+        _permission_key(row.allow, row.for_value, None if row.apply_to_all_doctypes else row.applicable_for)
+        for row in rows
+    })
+
+    ledger = []
+    for user_chunk in _chunk(users):
+        for key_chunk in _chunk(keys):
+            ledger += frappe.get_all(
+                "User Permission Provenance",
                 filters={
-                    "user": data["user"],
-                    "allow": data["doctype"],
-                    "for_value": data["docname"],
-                    "apply_to_all_doctypes": 0,
+                    "manager": manager,
+                    "user": ["in", user_chunk],
+                    "permission_key": ["in", key_chunk],
                 },
-                fields=["applicable_for"]
+                fields=["name", "user_permission"],
             )
-            existing_applicable_for = {row["applicable_for"] for row in existing if row["applicable_for"]}
-            if set(data["applicable_doctypes"]).issubset(existing_applicable_for):
-                continue
+    return ledger
 
-        elif existing:
-            continue
 
-        try:
-            add_user_permissions(data)
-            success += 1
-        except Exception:
-            errors.append(f"{data['user']}: {data['doctype']}/{data['docname']}")
+def backfill_provenance(docname):
+    """Claim the existing User Permissions that match the manager's last applied users and rows."""
+    users, rows = load_manager_rows([docname])[docname]
+    plan = plan_user_permissions(rows, users)
+    _claim_permissions(docname, plan["insert"] + plan["skip"], shared_only=False)
 
-    if success:
-        frappe.msgprint(_(f"Applied {success} user permission(s) successfully."))
 
-    if errors:
-        frappe.msgprint(_("Some errors occurred:<br>") + "<br>".join(errors))
+@contextmanager
+def permission_locks(parts):
+    """Hold the Redis locks guarding every (user, allow) pair of `parts` for the duration of the block.
 
-    return {"success": success, "errors": errors}
+    Callers keep the block to one chunk of users, see `LOCK_CHUNK_SIZE`, so
+    that a large apply never holds most of the locks at once.
 
+    `parts` are (users, rows) pairs. Pairs are hashed onto `LOCK_STRIPES`
+    locks, which are acquired in ascending order so that concurrent applies
+    cannot deadlock.
+    """
+    stripes = set()
+    for users, rows in parts:
+        doctypes = {row.allow for row in rows}
+        for user in users:
+            for allow in doctypes:
+                stripes.add(_lock_stripe(user, allow))
 
-def delete_user_permissions(docname):
-    doc = frappe.get_doc("User Permissions Manager", docname)
-    for user in doc.get_user_list():
-        for row in doc.user_permission_manager_mapper:
-            _safe_clear_permission_entry(user, row)
+    held = []
+    try:
+        for stripe in sorted(stripes):
+            lock = frappe.cache.lock(
+                frappe.cache.make_key(f"user_permissions_manager_lock::{stripe}"),
+                timeout=BACKGROUND_JOB_TIMEOUT,
+                blocking_timeout=LOCK_WAIT,
+            )
+            if not lock.acquire():
+                frappe.throw(
+                    _("User Permissions for these users are being applied by another process. Please try again."),
+                    title="User Permissions Locked",
+                )
+            held.append(lock)
+        yield
+    finally:
+        for lock in reversed(held):
+            try:
+                lock.release()
+            except LockError:
+                # Expired while held
+                pass
 
 
-def _safe_clear_permission_entry(user, row):
-    filters = {
-        "user": user,
-        "allow": row.allow,
-        "for_value": row.for_value,
-    }
-    if row.apply_to_all_doctypes:
-        filters["apply_to_all_doctypes"] = 1
-    else:
-        filters["apply_to_all_doctypes"] = 0
-        filters["applicable_for"] = row.applicable_for
+def _delta_users(delta):
+    return sorted({user for users, rows in delta["clear"] + delta["apply"] for user in users})
+
+
+def _lock_stripe(user, allow):
+    return int(hashlib.md5(f"{user}\n{allow}".encode()).hexdigest()[:8], 16) % LOCK_STRIPES
+
+
+def _permission_name(user, allow, for_value, applicable_for=None):
+    """Deterministic User Permission name, so that concurrent inserts of the same row collide."""
+    return hashlib.md5(f"{user}\n{allow}\n{for_value}\n{applicable_for or ''}".encode()).hexdigest()
+
+
+def _permission_key(allow, for_value, applicable_for=None):
+    return hashlib.md5(f"{allow}\n{for_value}\n{applicable_for or ''}".encode()).hexdigest()
+
+
+def _record_provenance(manager, records):
+    """Insert (user_permission, user, permission_key) ledger rows for `manager`."""
+    if not records:
+        return
+
+    now = frappe.utils.now()
+    owner = frappe.session.user
+    frappe.db.bulk_insert(
+        "User Permission Provenance",
+        fields=[
+            "name",
+            "creation",
+            "modified",
+            "owner",
+            "modified_by",
+            "manager",
+            "user_permission",
+            "user",
+            "permission_key",
+        ],
+        values=[
+            (frappe.generate_hash(length=10), now, now, owner, owner, manager, name, user, key)
+            for name, user, key in records
+        ],
+        chunk_size=BULK_INSERT_BATCH_SIZE,
+    )
+
+
+def _record_fallback_provenance(manager, data):
+    """Find the rows `add_user_permissions` just inserted for `data` and record them."""
+    records = []
+    for perm in frappe.get_all(
+        "User Permission",
+        filters={"user": data["user"], "allow": data["doctype"], "for_value": data["docname"]},
+        fields=["name", "apply_to_all_doctypes", "applicable_for"],
+    ):
+        applicable_for = None if perm.apply_to_all_doctypes else perm.applicable_for
+        if applicable_for in data["insert_for"]:
+            records.append((perm.name, data["user"], _permission_key(data["doctype"], data["docname"], applicable_for)))
+    _record_provenance(manager, records)
+
+
+def _claim_permissions(manager, entries, shared_only=True):
+    """Record `manager` as an owner of the existing rows its planned entries rely on.
+
+    With `shared_only`, only rows already owned by another manager are claimed,
+    so that permissions created by hand are never removed by a manager.
+    """
+    relied = {}
+    for data in entries:
+        for name, applicable_for in data.get("existing", []):
+            relied[name] = (data["user"], _permission_key(data["doctype"], data["docname"], applicable_for))
+
+    owners = defaultdict(set)
+    for chunk in _chunk(relied):
+        for row in frappe.get_all(
+            "User Permission Provenance",
+            filters={"user_permission": ["in", chunk]},
+            fields=["user_permission", "manager"],
+        ):
+            owners[row.user_permission].add(row.manager)
+
+    _record_provenance(manager, [
+        (name, user, key)
+        for name, (user, key) in relied.items()
+        if manager not in owners[name] and (owners[name] or not shared_only)
+    ])
+
+
+def _release_provenance(ledger):
+    """Drop ledger rows and delete the User Permissions no remaining ledger row references."""
+    for chunk in _chunk([row.name for row in ledger]):
+        frappe.db.delete("User Permission Provenance", {"name": ["in", chunk]})
+
+    permissions = {row.user_permission for row in ledger}
+    still_owned = set()
+    for chunk in _chunk(permissions):
+        still_owned.update(frappe.get_all(
+            "User Permission Provenance",
+            filters={"user_permission": ["in", chunk]},
+            pluck="user_permission",
+        ))
+
+    removed = 0
+    for chunk in _chunk(permissions - still_owned):
+        frappe.db.delete("User Permission", {"name": ["in", chunk]})
+        removed += frappe.db._cursor.rowcount
+
+    return removed
+
 
-    frappe.db.delete("User Permission", filters)
+def _unreferenced_permissions(ledger):
+    """Return the User Permissions that releasing `ledger` would delete, without deleting anything."""
+    dropped = {row.name for row in ledger}
+    permissions = {row.user_permission for row in ledger}
+    for chunk in _chunk(permissions):
+        for row in frappe.get_all(
+            "User Permission Provenance",
+            filters={"user_permission": ["in", chunk]},
+            fields=["name", "user_permission"],
+        ):
+            if row.name not in dropped:
+                permissions.discard(row.user_permission)
+    return permissions
@@ -0,0 +1,318 @@
+# Copyright (c) 2025, Dhwani RIS and contributors
+# License: MIT
+
+"""Import (user, doctype, value, applicable_for) lines from CSV or XLSX files.
+
+Lines are read one at a time and handled in chunks: each chunk is checked
+with a few batched existence queries, appended to the paged rows of one
+User Permissions Manager per user and applied through the bulk write path,
+then committed. Only the added rows are validated and written, against the
+stored rows sharing their (allow, for_value), so memory use and the work
+per chunk depend on the chunk size, not on the size of the file.
+"""
+
+import csv
+import os
+from collections import defaultdict
+
+import frappe
+from frappe import _
+from frappe.utils import cint, scrub
+from openpyxl import load_workbook
+
+from frappe_permission_manager.frappe_permission_manager.doctype.user_permissions_manager.user_permissions_manager import (
+    BACKGROUND_JOB_TIMEOUT,
+    LOCK_CHUNK_SIZE,
+    MANAGED_DOCTYPES_CACHE_KEY,
+    MAPPER_FIELDS,
+    MAPPER_PARENTFIELDS,
+    PAGED_MAPPER_FIELD,
+    _chunk,
+    _claim_permissions,
+    insert_paged_rows,
+    load_permission_snapshot,
+    permission_locks,
+    plan_user_permissions,
+    refresh_user_permission_cache,
+    write_user_permissions,
+)
+
+# Lines validated, saved and committed together
+IMPORT_CHUNK_SIZE = 1000
+# Invalid lines reported back individually; the rest are only counted
+IMPORT_ERROR_LIMIT = 100
+COLUMN_ALIASES = {
+    "doctype": "allow",
+    "document_type": "allow",
+    "value": "for_value",
+}
+
+
+@frappe.whitelist()
+def import_user_permissions(file_url, title=None):
+    """Queue the import of an uploaded CSV or XLSX file.
+
+    Managers are named "<title>: <user>", `title` defaulting to the file
+    name, so importing the same file again adds to the same managers.
+    """
+    frappe.has_permission("User Permissions Manager", "create", throw=True)
+    file = frappe.get_doc("File", {"file_url": file_url})
+    title = title or os.path.splitext(file.file_name)[0]
+
+    frappe.enqueue(
+        "frappe_permission_manager.frappe_permission_manager.importer.run_import",
+        queue="long",
+        timeout=BACKGROUND_JOB_TIMEOUT,
+        enqueue_after_commit=True,
+        path=file.get_full_path(),
+        title=title,
+        notify=frappe.session.user,
+    )
+    frappe.msgprint(_("User Permissions will be imported in the background."), alert=True, indicator="blue")
+
+
+def run_import(path, title, notify=None):
+    result = import_lines(read_lines(path), title)
+    if notify:
+        frappe.publish_realtime("user_permissions_manager_import", result, user=notify)
+    return result
+
+
+def read_lines(path):
+    """Yield each data line of a CSV or XLSX file as a dict keyed by the scrubbed header.
+
+    Blank lines are skipped; lines with more or fewer values than the header
+    are yielded with only an `_error`, to be reported as invalid.
+    """
+    if path.lower().endswith(".xlsx"):
+        workbook = load_workbook(path, read_only=True)
+        try:
+            rows = workbook.active.iter_rows(values_only=True)
+            header = _parse_header(next(rows, ()))
+            yield from _parse_lines(header, rows)
+        finally:
+            workbook.close()
+        return
+
+    with open(path, newline="", encoding="utf-8-sig") as f:
+        reader = csv.reader(f)
+        header = _parse_header(next(reader, ()))
+        yield from _parse_lines(header, reader)
+
+
+def _parse_lines(header, rows):
+    for number, values in enumerate(rows, start=2):
+        if not any(values):
+            continue
+        try:
+            yield dict(zip(header, values, strict=True))
+        except ValueError:
+            yield {"_error": _("Line {0}: {1} value(s) for {2} column(s)").format(number, len(values), len(header))}
+
+
+def _parse_header(header):
+    header = [COLUMN_ALIASES.get(scrub(str(h or "")), scrub(str(h or ""))) for h in header]
+    missing = {"user", "allow", "for_value"} - set(header)
+    if missing:
+        frappe.throw(_("Missing column(s) in import file: {0}").format(", ".join(sorted(missing))))
+    return header
+
+
+def import_lines(lines, title, chunk_size=IMPORT_CHUNK_SIZE):
+    """Import an iterable of line dicts into managers named "<title>: <user>".
+
+    Returns the number of lines imported and skipped, and the first
+    `IMPORT_ERROR_LIMIT` invalid lines.
+    """
+    result = {"imported": 0, "skipped": 0, "invalid": 0, "errors": []}
+    for chunk in _chunk_lines(lines, chunk_size):
+        valid = _validate_lines(chunk, result)
+        _import_chunk(valid, title, result)
+        frappe.db.commit()
+    return result
+
+
+def _chunk_lines(lines, size):
+    chunk = []
+    for line in lines:
+        if not any(line.values()):
+            continue
+        chunk.append(line)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def _validate_lines(lines, result):
+    malformed = [line for line in lines if line.get("_error")]
+    for line in malformed:
+        _add_error(result, line["_error"])
+    lines = [line for line in lines if not line.get("_error")]
+
+    for line in lines:
+        for field in ("user", "allow", "for_value", "applicable_for"):
+            line[field] = str(line.get(field) or "").strip() or None
+
+    users = set(frappe.get_all("User", filters={"name": ["in", list({l["user"] for l in lines if l["user"]})]}, pluck="name"))
+    doctypes = set(frappe.get_all(
+        "DocType",
+        filters={
+            "name": ["in", list({l[f] for l in lines for f in ("allow", "applicable_for") if l[f]})],
+            "issingle": 0,
+            "istable": 0,
+        },
+        pluck="name",
+    ))
+
+    values = defaultdict(set)
+    for line in lines:
+        if line["allow"] in doctypes and line["for_value"]:
+            values[line["allow"]].add(line["for_value"])
+    existing = set()
+    for allow, names in values.items():
+        for chunk in _chunk(names):
+            existing.update((allow, name) for name in frappe.get_all(allow, filters={"name": ["in", chunk]}, pluck="name"))
+
+    valid = []
+    for line in lines:
+        if line["user"] not in users:
+            error = _("User {0} not found").format(line["user"])
+        elif line["allow"] not in doctypes:
+            error = _("DocType {0} not found").format(line["allow"])
+        elif (line["allow"], line["for_value"]) not in existing:
+            error = _("{0} {1} not found").format(line["allow"], line["for_value"])
+        elif line["applicable_for"] and line["applicable_for"] not in doctypes:
+            error = _("DocType {0} not found").format(line["applicable_for"])
+        else:
+            valid.append(line)
+            continue
+
+        _add_error(result, error)
+
+    return valid
+
+
+def _add_error(result, error):
+    result["invalid"] += 1
+    if len(result["errors"]) < IMPORT_ERROR_LIMIT:
+        result["errors"].append(error)
+
+
+def _import_chunk(lines, title, result):
+    by_user = defaultdict(list)
+    for line in lines:
+        by_user[line["user"]].append(line)
+
+    planned = {}
+    for user, user_lines in by_user.items():
+        name = f"{title}: {user}"
+        try:
+            _ensure_paged_manager(name, user)
+        except frappe.ValidationError as e:
+            result["invalid"] += len(user_lines)
+            if len(result["errors"]) < IMPORT_ERROR_LIMIT:
+                result["errors"].append(f"{user}: {e}")
+            continue
+
+        stored = _load_stored_rows(name, user_lines)
+        seen = {(row.allow, row.for_value, row.applicable_for or None) for row in stored}
+        scopes = defaultdict(set)
+        for row in stored:
+            scopes[(row.allow, row.for_value)].add(bool(cint(row.apply_to_all_doctypes)))
+
+        added = []
+        for line in user_lines:
+            key = (line["allow"], line["for_value"], line["applicable_for"])
+            if key in seen:
+                result["skipped"] += 1
+                continue
+            scope = scopes[key[:2]]
+            if scope and scope != {not line["applicable_for"]}:
+                error = _("Conflicting global and scoped permissions for '{0}' and value '{1}'.")
+                _add_error(result, f"{user}: " + error.format(line["allow"], line["for_value"]))
+                continue
+            seen.add(key)
+            scope.add(not line["applicable_for"])
+            added.append(frappe._dict(
+                allow=line["allow"],
+                rule_type="Value",
+                for_value=line["for_value"],
+                applicable_for=line["applicable_for"],
+                apply_to_all_doctypes=0 if line["applicable_for"] else 1,
+                is_default=0,
+                hide_descendants=0,
+            ))
+
+        if not added:
+            continue
+
+        insert_paged_rows(name, PAGED_MAPPER_FIELD, added)
+        result["imported"] += len(added)
+        # Added rows are planned with the stored rows sharing their (allow, for_value)
+        touched = {(row.allow, row.for_value) for row in added}
+        planned[user] = (name, [row for row in stored if (row.allow, row.for_value) in touched] + added)
+    frappe.cache.delete_value(MANAGED_DOCTYPES_CACHE_KEY)
+
+    for chunk in _chunk(planned, LOCK_CHUNK_SIZE):
+        with permission_locks([([user], planned[user][1]) for user in chunk]):
+            doctypes = {row.allow for user in chunk for row in planned[user][1]}
+            snapshot = load_permission_snapshot(chunk, doctypes)
+            for user in chunk:
+                name, rows = planned[user]
+                plan = plan_user_permissions(rows, [user], snapshot=snapshot)
+                written = write_user_permissions(plan["insert"], manager=name)
+                result["errors"] += written["errors"][:IMPORT_ERROR_LIMIT - len(result["errors"])]
+                _claim_permissions(name, plan["insert"] + plan["skip"])
+
+    refresh_user_permission_cache(planned)
+
+
+def _ensure_paged_manager(name, user):
+    """Create the paged manager `name` for `user`, or move an existing one to paged mode.
+
+    Imported rows are then appended to its paged table without loading or
+    saving the document.
+    """
+    paged_mode = frappe.db.get_value("User Permissions Manager", name, "paged_mode")
+    if paged_mode:
+        return
+
+    if paged_mode is None:
+        doc = frappe.new_doc("User Permissions Manager")
+        doc.name = name
+        doc.paged_mode = 1
+        doc.append("users", {"user": user})
+        doc.flags.skip_permission_apply = True
+        doc.insert()
+        return
+
+    # Managers from earlier imports keep their rows, which this one save moves to the paged table
+    doc = frappe.get_doc("User Permissions Manager", name)
+    doc.paged_mode = 1
+    doc.flags.skip_permission_apply = True
+    doc.save()
+
+
+def _load_stored_rows(name, lines):
+    """Return the manager's stored rows for the (allow, for_value) pairs of `lines`."""
+    values = defaultdict(set)
+    for line in lines:
+        values[line["allow"]].add(line["for_value"])
+
+    rows = []
+    for allow, names in values.items():
+        for chunk in _chunk(names):
+            rows += frappe.get_all(
+                "User Permissions Manager Child",
+                filters={
+                    "parent": name,
+                    "parenttype": "User Permissions Manager",
+                    "parentfield": ["in", MAPPER_PARENTFIELDS],
+                    "allow": allow,
+                    "for_value": ["in", chunk],
+                },
+                fields=MAPPER_FIELDS,
+            )
+    return rows
@@ -0,0 +1,92 @@
+# Copyright (c) 2025, Dhwani RIS and contributors
+# License: MIT
+
+import json
+import time
+from contextlib import contextmanager
+
+import frappe
+
+
+class OperationMetrics:
+    """Per-stage timings, query counts and row counts for one manager operation.
+
+    Usage::
+
+        metrics = OperationMetrics("Territory North", "Update")
+        with metrics.stage("insert"):
+            ...
+        metrics.add(inserted=120)
+        metrics.save()
+    """
+
+    def __init__(self, manager, operation):
+        self.manager = manager
+        self.operation = operation
+        self.stages = {}
+        self.counts = {"inserted": 0, "skipped": 0, "deleted": 0, "users_invalidated": 0, "missing": 0, "orphaned": 0}
+
+    @contextmanager
+    def stage(self, name):
+        with count_queries() as stats:
+            start = time.perf_counter()
+            try:
+                yield
+            finally:
+                current = self.stages.setdefault(name, {"seconds": 0, "queries": 0})
+                current["seconds"] = round(current["seconds"] + time.perf_counter() - start, 4)
+                current["queries"] += stats["queries"]
+
+    def add(self, **counts):
+        for key, value in counts.items():
+            self.counts[key] += value
+
+    def as_dict(self):
+        return {
+            "operation": self.operation,
+            "seconds": round(sum(s["seconds"] for s in self.stages.values()), 4),
+            "queries": sum(s["queries"] for s in self.stages.values()),
+            **self.counts,
+            "stages": self.stages,
+        }
+
+    def save(self):
+        """Persist the metrics as a User Permissions Manager Log."""
+        metrics = self.as_dict()
+        log = frappe.get_doc({
+            "doctype": "User Permissions Manager Log",
+            "manager": self.manager,
+            "operation": self.operation,
+            "seconds": metrics["seconds"],
+            "queries": metrics["queries"],
+            "inserted": metrics["inserted"],
+            "skipped": metrics["skipped"],
+            "deleted": metrics["deleted"],
+            "users_invalidated": metrics["users_invalidated"],
+            "missing": metrics["missing"],
+            "orphaned": metrics["orphaned"],
+            "stages": json.dumps(metrics["stages"], indent=1),
+        })
+        # Trash logs are written once the manager is gone, by its cleanup job
+        log.flags.ignore_links = self.operation == "Trash"
+        log.insert(ignore_permissions=True)
+
+
+@contextmanager
+def count_queries():
+    """Count SQL statements, and rows affected by writes, issued through `frappe.db.sql`."""
+    stats = {"queries": 0, "rows_written": 0}
+    sql = frappe.db.sql
+
+    def counted_sql(query, *args, **kwargs):
+        result = sql(query, *args, **kwargs)
+        stats["queries"] += 1
+        if str(query).lstrip()[:6].lower() in ("insert", "update", "delete"):
+            stats["rows_written"] += max(frappe.db._cursor.rowcount, 0)
+        return result
+
+    frappe.db.sql = counted_sql
+    try:
+        yield stats
+    finally:
+        frappe.db.sql = sql
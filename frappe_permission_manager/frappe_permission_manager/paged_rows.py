@@ -0,0 +1,194 @@
+# Copyright (c) 2025, Dhwani RIS and contributors
+# License: MIT
+
+"""Paged storage and editing of the rows of large User Permissions Managers.
+
+With `paged_mode` set, a manager's mapper rows and users are kept under
+parentfields that are not in the doctype's meta, so the document is loaded
+and saved without them. The form reads them a page at a time and edits
+them through the endpoints below. Each edit is validated against the
+stored rows of the same doctypes and applies only what it changes: edited
+rows are planned together with the stored rows sharing their
+(allow, for_value), and added or removed users against every row.
+"""
+
+import frappe
+from frappe import _
+from frappe.utils import cint
+
+from frappe_permission_manager.frappe_permission_manager.doctype.user_permissions_manager.user_permissions_manager import (
+    FILTER_RULE_INDEX_CACHE_KEY,
+    MANAGED_DOCTYPES_CACHE_KEY,
+    MAPPER_FIELDS,
+    MAPPER_PARENTFIELDS,
+    PAGED_MAPPER_FIELD,
+    PAGED_USERS_FIELD,
+    USER_PARENTFIELDS,
+    _chunk,
+    get_manager_rows,
+    get_stored_rows,
+    get_stored_users,
+    insert_paged_rows,
+    plan_permission_delta,
+)
+
+PAGE_LENGTH = 50
+
+
+@frappe.whitelist()
+def get_paged_rows(docname, table="mapper", start=0, page_length=PAGE_LENGTH):
+    """Return one page of the mapper rows, or with `table="users"` of the users, and their total."""
+    frappe.has_permission("User Permissions Manager", "read", docname, throw=True)
+    if table == "users":
+        doctype, fields = "User Permissions Manager Child User", ["name", "idx", "user"]
+        filters = _filters(docname, USER_PARENTFIELDS)
+    else:
+        doctype, fields = "User Permissions Manager Child", ["name", "idx", *MAPPER_FIELDS]
+        filters = _filters(docname, MAPPER_PARENTFIELDS)
+
+    return {
+        "rows": frappe.get_all(
+            doctype,
+            filters=filters,
+            fields=fields,
+            order_by="idx",
+            limit_start=cint(start),
+            limit_page_length=cint(page_length) or PAGE_LENGTH,
+        ),
+        "total": frappe.db.count(doctype, filters),
+    }
+
+
+@frappe.whitelist()
+def upsert_paged_rows(docname, rows):
+    """Insert rows without a `name` and update the others, then apply what they change."""
+    doc = _get_paged_manager(docname)
+    rows = frappe.parse_json(rows)
+    for row in rows:
+        doc.append("user_permission_manager_mapper", row)
+
+    # The document carries only the edited rows; stored rows of the same doctypes are checked along
+    doc.validate_filter_rules()
+    doc.validate_user_permission()
+    doc.validate_default_permission()
+    doc.validate_cross_manager_conflicts()
+
+    edited = doc.user_permission_manager_mapper
+    before = _load_rows(docname, [row.name for row in edited if row.name])
+    missing = {row.name for row in edited if row.name} - {row.name for row in before}
+    if missing:
+        frappe.throw(_("Rows {0} not found in {1}").format(", ".join(sorted(missing)), docname))
+
+    related = _related_rows(docname, before + list(edited))
+    for row in edited:
+        if row.name:
+            frappe.db.set_value(
+                "User Permissions Manager Child", row.name, {field: row.get(field) for field in MAPPER_FIELDS}
+            )
+    inserted = insert_paged_rows(docname, PAGED_MAPPER_FIELD, [row for row in edited if not row.name])
+
+    users = get_stored_users(docname)
+    _apply(doc, plan_permission_delta(users, related + before, users, related + list(edited)))
+    return [row.name for row in edited if row.name] + [row.name for row in inserted]
+
+
+@frappe.whitelist()
+def delete_paged_rows(docname, names):
+    """Delete mapper rows by name and clear the permissions only they gave."""
+    doc = _get_paged_manager(docname)
+    before = _load_rows(docname, frappe.parse_json(names))
+    if not before:
+        return
+
+    related = _related_rows(docname, before)
+    frappe.db.delete("User Permissions Manager Child", {"name": ["in", [row.name for row in before]]})
+
+    users = get_stored_users(docname)
+    _apply(doc, plan_permission_delta(users, related + before, users, related))
+
+
+@frappe.whitelist()
+def add_paged_users(docname, users):
+    """Add users to a paged manager and give them every row."""
+    doc = _get_paged_manager(docname, users_editable=True)
+    stored = set(get_stored_users(docname))
+    users = [user for user in dict.fromkeys(frappe.parse_json(users)) if user not in stored]
+    if not users:
+        return
+
+    existing = set()
+    for chunk in _chunk(users):
+        existing.update(frappe.get_all("User", filters={"name": ["in", chunk]}, pluck="name"))
+    missing = [user for user in users if user not in existing]
+    if missing:
+        frappe.throw(_("User(s) {0} not found").format(", ".join(missing)))
+
+    # Other managers' defaults are checked against every stored row, for the added users only
+    doc.set("user_permission_manager_mapper", get_stored_rows(docname))
+    doc._user_list = users
+    doc.validate_cross_manager_conflicts()
+
+    insert_paged_rows(docname, PAGED_USERS_FIELD, [{"user": user} for user in users])
+    rows = get_manager_rows(docname)
+    _apply(doc, plan_permission_delta([], rows, users, rows))
+
+
+@frappe.whitelist()
+def remove_paged_users(docname, users):
+    """Remove users from a paged manager and clear the permissions it gave them."""
+    doc = _get_paged_manager(docname, users_editable=True)
+    users = list(set(frappe.parse_json(users)) & set(get_stored_users(docname)))
+    if not users:
+        return
+
+    for chunk in _chunk(users):
+        frappe.db.delete(
+            "User Permissions Manager Child User", {**_filters(docname, USER_PARENTFIELDS), "user": ["in", chunk]}
+        )
+    rows = get_manager_rows(docname)
+    _apply(doc, plan_permission_delta(users, rows, [], rows))
+
+
+def _get_paged_manager(docname, users_editable=False):
+    doc = frappe.get_doc("User Permissions Manager", docname)
+    doc.check_permission("write")
+    if not doc.paged_mode:
+        frappe.throw(_("User Permissions Manager {0} is not in paged mode.").format(docname))
+    if users_editable and doc.apply_to_role:
+        frappe.throw(_("Users of a role based User Permissions Manager follow its roles."))
+    doc.validate_strict_user_permission_enabled()
+    return doc
+
+
+def _apply(doc, delta):
+    frappe.cache.delete_value([FILTER_RULE_INDEX_CACHE_KEY, MANAGED_DOCTYPES_CACHE_KEY])
+    doc.apply_delta(delta, operation="Paged Edit")
+
+
+def _filters(docname, parentfields):
+    return {"parent": docname, "parenttype": "User Permissions Manager", "parentfield": ["in", parentfields]}
+
+
+def _load_rows(docname, names):
+    if not names:
+        return []
+    return frappe.get_all(
+        "User Permissions Manager Child",
+        filters={**_filters(docname, [PAGED_MAPPER_FIELD]), "name": ["in", names]},
+        fields=["name", *MAPPER_FIELDS],
+    )
+
+
+def _related_rows(docname, rows):
+    """Return the stored rows, other than `rows`, sharing an (allow, for_value) with `rows`.
+
+    Every stored row of a doctype is related to a filter rule on it.
+    """
+    names = {row.name for row in rows if row.name}
+    rule_allows = {row.allow for row in rows if row.rule_type == "Filter"}
+    values = {(row.allow, row.for_value) for row in rows if row.rule_type != "Filter"}
+    return [
+        row
+        for row in get_stored_rows(docname, list({row.allow for row in rows}))
+        if row.name not in names and (row.allow in rule_allows or (row.allow, row.for_value) in values)
+    ]
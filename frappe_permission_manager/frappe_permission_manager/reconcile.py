@@ -0,0 +1,211 @@
+# Copyright (c) 2025, Dhwani RIS and contributors
+# License: MIT
+
+"""Nightly comparison of the permissions managers should give with the ones that exist.
+
+Users are streamed in name order, a chunk at a time. For each chunk the
+expected (manager, user, permission key) set is built from the managers'
+users and mapper rows, the actual set is read from the provenance ledger
+joined to User Permission, and both are sorted and merge-joined:
+
+* missing - expected, but neither recorded for the manager nor present
+  in the User Permission table
+* orphaned - recorded for the manager, but no longer given by its rows
+
+Set `user_permissions_manager_reconcile_mode` to "repair" in site config
+to fix the drift; by default it is only counted in a User Permissions
+Manager Log.
+"""
+
+from collections import defaultdict
+
+import frappe
+
+from frappe_permission_manager.frappe_permission_manager.doctype.user_permissions_manager.user_permissions_manager import (
+    LOCK_CHUNK_SIZE,
+    USER_PARENTFIELDS,
+    _chunk,
+    _claim_permissions,
+    _permission_key,
+    _release_provenance,
+    load_manager_rows,
+    load_permission_snapshot,
+    permission_locks,
+    plan_manager_permissions,
+    refresh_user_permission_cache,
+    write_user_permissions,
+)
+from frappe_permission_manager.frappe_permission_manager.instrumentation import OperationMetrics
+
+# Users compared per chunk
+RECONCILE_CHUNK_SIZE = 1000
+
+
+def reconcile_user_permissions(mode=None, chunk_size=RECONCILE_CHUNK_SIZE):
+    """Count, and in "repair" mode fix, missing and orphaned manager permissions."""
+    mode = mode or frappe.conf.get("user_permissions_manager_reconcile_mode") or "report"
+    metrics = OperationMetrics(None, "Repair" if mode == "repair" else "Reconcile")
+    manager_rows = {}
+
+    for users in _stream_users(chunk_size):
+        with metrics.stage("lookup"):
+            expected = _expected_permissions(users, manager_rows)
+            ledger = _recorded_permissions(users)
+            snapshot = load_permission_snapshot(users, {row.allow for row in expected.values()})
+
+        with metrics.stage("compare"):
+            missing, orphaned, stale = merge_join(sorted(expected), ledger)
+            missing = [key for key in missing if not _exists(expected[key], key[1], snapshot)]
+        metrics.add(missing=len(missing), orphaned=len(orphaned))
+
+        if mode != "repair" or not (missing or orphaned or stale):
+            continue
+
+        with metrics.stage("repair"):
+            metrics.add(deleted=_release_provenance(orphaned + stale))
+            written = _restore_missing(missing, expected, manager_rows)
+            metrics.add(inserted=written["inserted"], deleted=written["removed"])
+            refresh_user_permission_cache({key[1] for key in missing} | {row.user for row in orphaned})
+        frappe.db.commit()
+
+    metrics.save()
+    return metrics.as_dict()
+
+
+def merge_join(expected, ledger):
+    """Compare sorted (manager, user, permission_key) keys with sorted ledger rows.
+
+    Returns the missing keys, the orphaned ledger rows, and the ledger rows
+    whose User Permission no longer exists although it is still expected.
+    """
+    missing, orphaned, stale = [], [], []
+    i = j = 0
+    while i < len(expected) or j < len(ledger):
+        row_key = ledger[j].key if j < len(ledger) else None
+        if row_key is None or (i < len(expected) and expected[i] < row_key):
+            missing.append(expected[i])
+            i += 1
+        elif i == len(expected) or row_key < expected[i]:
+            orphaned.append(ledger[j])
+            j += 1
+        else:
+            found = False
+            while j < len(ledger) and ledger[j].key == expected[i]:
+                if ledger[j].exists:
+                    found = True
+                else:
+                    stale.append(ledger[j])
+                j += 1
+            if not found:
+                missing.append(expected[i])
+            i += 1
+
+    return missing, orphaned, stale
+
+
+def _stream_users(chunk_size):
+    last = ""
+    while True:
+        users = frappe.get_all(
+            "User", filters={"name": [">", last]}, order_by="name", limit=chunk_size, pluck="name"
+        )
+        if not users:
+            return
+        yield users
+        last = users[-1]
+
+
+def _expected_permissions(users, manager_rows):
+    """Return {(manager, user, permission_key): row} for the managers covering `users`.
+
+    Mapper rows are read once per manager and kept in `manager_rows` for
+    later chunks.
+    """
+    assignments = frappe.get_all(
+        "User Permissions Manager Child User",
+        filters={
+            "user": ["in", users],
+            "parenttype": "User Permissions Manager",
+            "parentfield": ["in", USER_PARENTFIELDS],
+        },
+        fields=["parent", "user"],
+    )
+    uncached = list({row.parent for row in assignments} - set(manager_rows))
+    for manager, (_, rows) in load_manager_rows(uncached, with_users=False).items():
+        manager_rows[manager] = rows
+
+    expected = {}
+    for assignment in assignments:
+        for row in manager_rows[assignment.parent]:
+            key = _permission_key(row.allow, row.for_value, row.applicable_for)
+            expected[(assignment.parent, assignment.user, key)] = row
+    return expected
+
+
+def _recorded_permissions(users):
+    """Return the ledger rows of `users`, sorted by (manager, user, permission_key)."""
+    provenance = frappe.qb.DocType("User Permission Provenance")
+    permission = frappe.qb.DocType("User Permission")
+    rows = (
+        frappe.qb.from_(provenance)
+        .left_join(permission)
+        .on(permission.name == provenance.user_permission)
+        .select(
+            provenance.name,
+            provenance.manager,
+            provenance.user,
+            provenance.permission_key,
+            provenance.user_permission,
+            permission.name.as_("existing"),
+        )
+        .where(provenance.user.isin(users))
+        .run(as_dict=True)
+    )
+    for row in rows:
+        row.key = (row.manager, row.user, row.permission_key)
+        row.exists = bool(row.existing)
+    return sorted(rows, key=lambda row: row.key)
+
+
+def _exists(row, user, snapshot):
+    state = snapshot[0].get((user, row.allow, row.for_value))
+    if not state:
+        return False
+    if row.apply_to_all_doctypes:
+        return bool(state["global"])
+    return row.applicable_for in state["scoped"]
+
+
+def _restore_missing(missing, expected, manager_rows):
+    """Re-apply the missing permissions, with every row sharing their (allow, for_value).
+
+    Users are locked, read and written `LOCK_CHUNK_SIZE` at a time.
+    """
+    parts = defaultdict(lambda: (set(), set()))
+    for key in missing:
+        row = expected[key]
+        parts[key[0]][0].add(key[1])
+        parts[key[0]][1].add((row.allow, row.for_value))
+
+    rows = {
+        manager: [row for row in manager_rows[manager] if (row.allow, row.for_value) in values]
+        for manager, (users, values) in parts.items()
+    }
+    written = {"inserted": 0, "removed": 0}
+    for chunk in _chunk(sorted({key[1] for key in missing}), LOCK_CHUNK_SIZE):
+        chunk_parts = {
+            manager: [(sorted(users.intersection(chunk)), rows[manager])]
+            for manager, (users, values) in parts.items()
+            if users.intersection(chunk)
+        }
+        locked = [part for manager_parts in chunk_parts.values() for part in manager_parts]
+        with permission_locks(locked):
+            doctypes = {row.allow for manager in chunk_parts for row in rows[manager]}
+            snapshot = load_permission_snapshot(chunk, doctypes)
+            entries, relied, _ = plan_manager_permissions(chunk_parts, snapshot)
+            result = write_user_permissions(entries)
+            for manager, manager_entries in relied.items():
+                _claim_permissions(manager, manager_entries)
+        written["inserted"] += result["inserted"]
+        written["removed"] += result["removed"]
+    return written
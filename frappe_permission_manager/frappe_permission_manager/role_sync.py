@@ -0,0 +1,90 @@
+# Copyright (c) 2025, Dhwani RIS and contributors
+# License: MIT
+
+import frappe
+
+from frappe_permission_manager.frappe_permission_manager.doctype.user_permissions_manager.user_permissions_manager import (
+    PAGED_USERS_FIELD,
+    USER_PARENTFIELDS,
+    apply_permission_delta,
+    get_manager_rows,
+    get_role_manager_index,
+    plan_permission_delta,
+)
+
+
+def sync_user_roles(doc, method=None):
+    """User hook: update permissions from role-based managers when roles change."""
+    old_doc = doc.get_doc_before_save()
+    current_roles = {d.role for d in doc.roles}
+    previous_roles = {d.role for d in old_doc.roles} if old_doc else set()
+
+    if current_roles != previous_roles:
+        sync_role_change(doc.name, previous_roles, current_roles)
+
+
+def sync_added_role(doc, method=None):
+    """Has Role hook for roles inserted on their own, outside a User save."""
+    if doc.parenttype != "User":
+        return
+    current_roles = _get_roles(doc.parent)
+    sync_role_change(doc.parent, current_roles - {doc.role}, current_roles)
+
+
+def sync_removed_role(doc, method=None):
+    """Has Role hook for roles deleted on their own, outside a User save."""
+    if doc.parenttype != "User":
+        return
+    current_roles = _get_roles(doc.parent) - {doc.role}
+    sync_role_change(doc.parent, current_roles | {doc.role}, current_roles)
+
+
+def sync_role_change(user, previous_roles, current_roles):
+    """Add or remove `user`'s permissions for managers whose roles the user gained or lost.
+
+    Only managers indexed under a changed role are touched, and only for this
+    user, so no manager has to be re-saved.
+    """
+    index = get_role_manager_index()
+    managers = set()
+    for role in previous_roles ^ current_roles:
+        managers.update(index.get(role, []))
+
+    for manager in sorted(managers):
+        manager_roles = {role for role, names in index.items() if manager in names}
+        was_member = bool(manager_roles & previous_roles)
+        is_member = bool(manager_roles & current_roles)
+        if was_member == is_member:
+            continue
+
+        rows = get_manager_rows(manager)
+        delta = plan_permission_delta(
+            [user] if was_member else [], rows, [user] if is_member else [], rows
+        )
+        # Role changes follow managers a System Manager set up, whoever edits the roles
+        apply_permission_delta(delta, manager, operation="Role Sync", ignore_permissions=True)
+        _update_user_snapshot(manager, user, is_member)
+
+
+def _update_user_snapshot(manager, user, is_member):
+    """Keep the manager's `users` table, its last applied user set, in step."""
+    filters = {"parent": manager, "parenttype": "User Permissions Manager", "parentfield": ["in", USER_PARENTFIELDS]}
+    if not is_member:
+        frappe.db.delete("User Permissions Manager Child User", {**filters, "user": user})
+        return
+
+    if frappe.db.exists("User Permissions Manager Child User", {**filters, "user": user}):
+        return
+
+    paged = frappe.db.get_value("User Permissions Manager", manager, "paged_mode")
+    frappe.get_doc({
+        "doctype": "User Permissions Manager Child User",
+        "user": user,
+        "idx": frappe.db.count("User Permissions Manager Child User", filters) + 1,
+        **filters,
+        "parentfield": PAGED_USERS_FIELD if paged else "users",
+    }).db_insert()
+
+
+def _get_roles(user):
+    return set(frappe.get_all("Has Role", filters={"parent": user, "parenttype": "User"}, pluck="role"))
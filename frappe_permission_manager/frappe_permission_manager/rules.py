@@ -0,0 +1,118 @@
+# Copyright (c) 2025, Dhwani RIS and contributors
+# License: MIT
+
+import json
+from collections import defaultdict
+
+import frappe
+
+from frappe_permission_manager.frappe_permission_manager.doctype.user_permissions_manager.user_permissions_manager import (
+    MAPPER_PARENTFIELDS,
+    USER_PARENTFIELDS,
+    _chunk,
+    _is_background_workload,
+    _permission_key,
+    _row_values,
+    apply_permission_delta,
+    enqueue_permission_jobs,
+    get_filter_rule_index,
+    get_managed_doctypes,
+)
+
+
+def apply_filter_rules(doc, method=None):
+    """Document hook: give a new record to the users of every filter rule it matches.
+
+    Only the new value is applied; the rest of each rule is left untouched.
+    Inserts of doctypes without filter rules return after one cached lookup.
+    """
+    if frappe.flags.in_install or frappe.flags.in_migrate:
+        return
+
+    rules = get_filter_rule_index().get(doc.doctype)
+    if not rules:
+        return
+
+    matched = defaultdict(list)
+    for rule in rules:
+        if _matches(doc, rule):
+            matched[rule.parent].append(frappe._dict(_row_values(rule), for_value=doc.name))
+
+    for manager, rows in matched.items():
+        users = frappe.get_all(
+            "User Permissions Manager Child User",
+            filters={
+                "parent": manager,
+                "parenttype": "User Permissions Manager",
+                "parentfield": ["in", USER_PARENTFIELDS],
+            },
+            pluck="user",
+        )
+        if not users:
+            continue
+
+        # Value rows for the same record are planned along, so that scoped rows are regrouped
+        rows += frappe.get_all(
+            "User Permissions Manager Child",
+            filters={
+                "parent": manager,
+                "parenttype": "User Permissions Manager",
+                "parentfield": ["in", MAPPER_PARENTFIELDS],
+                "allow": doc.doctype,
+                "for_value": doc.name,
+                "rule_type": ["!=", "Filter"],
+            },
+            fields=["allow", "for_value", "apply_to_all_doctypes", "applicable_for", "is_default", "hide_descendants"],
+        )
+        delta = {"clear": [], "apply": [(users, rows)]}
+
+        # Records are inserted by any user; the rules were set up by a System Manager
+        if _is_background_workload(delta["apply"]):
+            enqueue_permission_jobs(manager, users, delta, ignore_permissions=True)
+            continue
+
+        apply_permission_delta(delta, manager, operation="Filter Rule", ignore_permissions=True)
+
+
+def sync_renamed_value(doc, method=None, old=None, new=None, merge=False):
+    """Document hook: re-key the ledger of a renamed value and apply the filter rules it now matches.
+
+    Frappe renames `for_value` in User Permissions itself; only the ledger's
+    permission keys, which are derived from the value, need updating.
+    Renames of doctypes no manager covers return before any query.
+    """
+    if doc.doctype not in get_managed_doctypes():
+        return
+
+    permissions = frappe.get_all(
+        "User Permission",
+        filters={"allow": doc.doctype, "for_value": doc.name},
+        fields=["name", "apply_to_all_doctypes", "applicable_for"],
+    )
+
+    by_key = defaultdict(list)
+    for perm in permissions:
+        applicable_for = None if perm.apply_to_all_doctypes else perm.applicable_for
+        by_key[_permission_key(doc.doctype, doc.name, applicable_for)].append(perm.name)
+
+    for key, names in by_key.items():
+        for chunk in _chunk(names):
+            frappe.db.set_value(
+                "User Permission Provenance",
+                {"user_permission": ["in", chunk]},
+                "permission_key",
+                key,
+                update_modified=False,
+            )
+
+    apply_filter_rules(doc)
+
+
+def _matches(doc, rule):
+    filters = json.loads(rule.value_filters or "{}")
+    if isinstance(filters, dict):
+        filters = [
+            [field, *(value if isinstance(value, list | tuple) else ["=", value])]
+            for field, value in filters.items()
+        ]
+    return bool(frappe.get_all(doc.doctype, filters=[*filters, ["name", "=", doc.name]], limit=1))
@@ -26,7 +26,7 @@ app_license = "mit"
 
 # include js, css files in header of desk.html
 # app_include_css = "/assets/frappe_permission_manager/css/frappe_permission_manager.css"
-# app_include_js = "/assets/frappe_permission_manager/js/frappe_permission_manager.js"
+app_include_js = "/assets/frappe_permission_manager/js/frappe_permission_manager.js"
 
 # include js, css files in header of web template
 # web_include_css = "/assets/frappe_permission_manager/css/frappe_permission_manager.css"
@@ -132,34 +132,48 @@ app_license = "mit"
 # ---------------
 # Hook on document methods and events
 
-# doc_events = {
-# 	"*": {
-# 		"on_update": "method",
-# 		"on_cancel": "method",
-# 		"on_trash": "method"
-# 	}
-# }
+doc_events = {
+	"*": {
+		"after_insert": "frappe_permission_manager.frappe_permission_manager.rules.apply_filter_rules",
+		"on_update": "frappe_permission_manager.frappe_permission_manager.descendants.invalidate_descendants",
+		"on_trash": "frappe_permission_manager.frappe_permission_manager.descendants.invalidate_descendants",
+		"after_rename": [
+			"frappe_permission_manager.frappe_permission_manager.descendants.invalidate_descendants",
+			"frappe_permission_manager.frappe_permission_manager.rules.sync_renamed_value",
+		],
+	},
+	"User": {
+		"on_update": "frappe_permission_manager.frappe_permission_manager.role_sync.sync_user_roles",
+	},
+	"DocType": {
+		"on_update": "frappe_permission_manager.frappe_permission_manager.api.invalidate_applicable_for",
+		"on_trash": "frappe_permission_manager.frappe_permission_manager.api.invalidate_applicable_for",
+	},
+	"Custom Field": {
+		"on_update": "frappe_permission_manager.frappe_permission_manager.api.invalidate_applicable_for",
+		"on_trash": "frappe_permission_manager.frappe_permission_manager.api.invalidate_applicable_for",
+	},
+	"Property Setter": {
+		"on_update": "frappe_permission_manager.frappe_permission_manager.api.invalidate_applicable_for",
+		"on_trash": "frappe_permission_manager.frappe_permission_manager.api.invalidate_applicable_for",
+	},
+	"Has Role": {
+		"after_insert": "frappe_permission_manager.frappe_permission_manager.role_sync.sync_added_role",
+		"on_trash": "frappe_permission_manager.frappe_permission_manager.role_sync.sync_removed_role",
+	},
+	"User Permission": {
+		"on_trash": "frappe_permission_manager.frappe_permission_manager.doctype.user_permission_provenance.user_permission_provenance.on_user_permission_trash",
+	},
+}
 
 # Scheduled Tasks
 # ---------------
 
-# scheduler_events = {
-# 	"all": [
-# 		"frappe_permission_manager.tasks.all"
-# 	],
-# 	"daily": [
-# 		"frappe_permission_manager.tasks.daily"
-# 	],
-# 	"hourly": [
-# 		"frappe_permission_manager.tasks.hourly"
-# 	],
-# 	"weekly": [
-# 		"frappe_permission_manager.tasks.weekly"
-# 	],
-# 	"monthly": [
-# 		"frappe_permission_manager.tasks.monthly"
-# 	],
-# }
+scheduler_events = {
+	"daily_long": [
+		"frappe_permission_manager.frappe_permission_manager.reconcile.reconcile_user_permissions"
+	],
+}
 
 # Testing
 # -------
@@ -187,7 +201,7 @@ app_license = "mit"
 # Ignore links to specified DocTypes when deleting documents
 # -----------------------------------------------------------
 
-# ignore_links_on_delete = ["Communication", "ToDo"]
+ignore_links_on_delete = ["User Permission Provenance", "User Permissions Manager Log"]
 
 # Request Events
 # ----------------
@@ -233,7 +247,7 @@ app_license = "mit"
 # Automatically update python controller files with type annotations for this app.
 # export_python_type_annotations = True
 
-# default_log_clearing_doctypes = {
-# 	"Logging DocType Name": 30  # days to retain logs
-# }
+default_log_clearing_doctypes = {
+	"User Permissions Manager Log": 30  # days to retain logs
+}
 
@@ -0,0 +1,7 @@
+import frappe
+
+
+def execute():
+    """Support prefix search on user full names and role member lookups."""
+    frappe.db.add_index("User", ["full_name"])
+    frappe.db.add_index("Has Role", ["role", "parent"])
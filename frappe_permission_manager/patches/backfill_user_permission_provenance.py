@@ -0,0 +1,11 @@
+import frappe
+
+from frappe_permission_manager.frappe_permission_manager.doctype.user_permissions_manager.user_permissions_manager import (
+    backfill_provenance,
+)
+
+
+def execute():
+    """Record existing managers as owners of the User Permissions they created before the ledger existed."""
+    for name in frappe.get_all("User Permissions Manager", pluck="name"):
+        backfill_provenance(name)
@@ -0,0 +1,10 @@
+// Copyright (c) 2025, Dhwani RIS and contributors
+// For license information, please see license.txt
+
+// User Permissions Manager broadcasts one event per chunk of affected users
+// instead of one per user; reload permissions only if this user is listed.
+frappe.realtime.on("user_permissions_manager_refresh", (data) => {
+    if ((data.users || []).includes(frappe.session.user)) {
+        frappe.defaults.update_user_permissions();
+    }
+});